@@ -0,0 +1,262 @@
+"""
+События воронки в локальном колоночном хранилище и отчёты по ним.
+
+Каждый шаг воронки (metrics.step) добавляется в буфер в памяти — без I/O в event loop.
+Отдельный поток раз в ANALYTICS_FLUSH_INTERVAL секунд (или по заполнении буфера)
+сбрасывает буфер в сегмент: JSON по колонкам, строковые колонки словарно
+закодированы, всё сжато gzip. Сегменты неизменяемые, каждый процесс пишет свои.
+
+    python analytics.py funnel                       # конверсия по шагам
+    python analytics.py funnel --by city --top 20    # то же в разрезе городов
+    python analytics.py funnel --by citizenship --since 2026-10-01
+    python analytics.py steps                        # сколько раз случился каждый шаг
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import queue
+import logging
+import argparse
+import threading
+from datetime import datetime
+logger = logging.getLogger(__name__)
+
+
+# === НАСТРОЙКИ ===
+ANALYTICS_DIR = os.environ.get("ANALYTICS_DIR", "analytics")
+ANALYTICS_ENABLED = os.environ.get("ANALYTICS_ENABLED", "1") == "1"
+ANALYTICS_FLUSH_INTERVAL = float(os.environ.get("ANALYTICS_FLUSH_INTERVAL", "60"))
+ANALYTICS_BATCH_SIZE = int(os.environ.get("ANALYTICS_BATCH_SIZE", "50000"))
+
+SEGMENT_VERSION = 1
+# Колонки сегмента; строковые хранятся словарём значений и кодами строк
+DIMENSIONS = ("citizenship", "city", "delivery")
+STRING_COLUMNS = ("step",) + DIMENSIONS
+# Основной путь пользователя — по нему считается конверсия
+FUNNEL = (
+    "start", "calc_income", "age_18_plus", "citizenship_chosen",
+    "city_chosen", "income_shown", "lead_sent",
+)
+
+
+# ===============================
+# ЗАПИСЬ
+# ===============================
+
+def _encode_strings(values: list) -> dict:
+    dictionary = {}
+    codes = [dictionary.setdefault(v, len(dictionary)) if v is not None else -1 for v in values]
+    return {"dict": list(dictionary), "codes": codes}
+
+
+def write_segment(directory: str, rows: list[tuple]) -> str:
+    """rows — кортежи (ts, user, step, citizenship, city, delivery); возвращает путь сегмента."""
+    ts, users, steps, *dims = zip(*rows)
+    columns = {"ts": list(ts), "user": list(users), "step": _encode_strings(steps)}
+    for name, values in zip(DIMENSIONS, dims):
+        columns[name] = _encode_strings(values)
+    payload = {"version": SEGMENT_VERSION, "rows": len(rows), "columns": columns}
+
+    # Интервал времени — в имени файла: отчёт за период не открывает лишние сегменты
+    name = f"seg-{min(ts)}-{max(ts)}-{os.getpid()}-{time.monotonic_ns()}.json.gz"
+    path = os.path.join(directory, name)
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=6) as f:
+        json.dump(payload, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, path)
+    return path
+
+
+class EventSink:
+    """Буфер событий воронки и фоновый поток, который пишет его в сегменты."""
+
+    def __init__(self, directory: str = ANALYTICS_DIR, flush_interval: float = ANALYTICS_FLUSH_INTERVAL,
+                 batch_size: int = ANALYTICS_BATCH_SIZE):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._buffer: list[tuple] = []
+        self._lock = threading.Lock()
+        self._batches: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: threading.Thread | None = None
+        self.dropped = 0
+
+    def emit(self, step: str, user: int | None, fields: dict):
+        row = (
+            int(time.time()), user, step,
+            *(None if fields.get(d) is None else str(fields[d]) for d in DIMENSIONS),
+        )
+        with self._lock:
+            self._buffer.append(row)
+            full = len(self._buffer) >= self.batch_size
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._writer, daemon=True, name="analytics-writer")
+                self._thread.start()
+        if full:
+            self._batches.put(self._swap())
+
+    def _swap(self) -> list[tuple]:
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+        return rows
+
+    def _writer(self):
+        while True:
+            try:
+                rows = self._batches.get(timeout=self.flush_interval)
+            except queue.Empty:
+                rows = self._swap()
+            if rows is None:
+                return
+            self._write(rows)
+
+    def _write(self, rows: list[tuple]):
+        if not rows:
+            return
+        try:
+            write_segment(self.directory, rows)
+        except Exception:
+            self.dropped += len(rows)
+            logger.exception("Failed to write %d analytics events", len(rows))
+
+    def close(self):
+        # Дописываем остаток при остановке процесса
+        thread = self._thread
+        if thread is not None:
+            self._batches.put(self._swap())
+            self._batches.put(None)
+            thread.join(timeout=10)
+            self._thread = None
+
+
+_sink = EventSink() if ANALYTICS_ENABLED else None
+
+
+def emit(step: str, user: int | None, fields: dict):
+    if _sink is not None:
+        _sink.emit(step, user, fields)
+
+
+def close():
+    if _sink is not None:
+        _sink.close()
+
+
+# ===============================
+# ЧТЕНИЕ И ОТЧЁТЫ
+# ===============================
+
+def _segment_paths(directory: str, since: int | None, until: int | None):
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return
+    for name in names:
+        if not (name.startswith("seg-") and name.endswith(".json.gz")):
+            continue
+        first, last = (int(x) for x in name.split("-")[1:3])
+        if (since is not None and last < since) or (until is not None and first >= until):
+            continue
+        yield os.path.join(directory, name)
+
+
+def read_segments(directory: str = ANALYTICS_DIR, since: int | None = None, until: int | None = None):
+    """Колонки сегментов по одному: (ts, user, коды step, словарь step, {dim: (коды, словарь)})."""
+    for path in _segment_paths(directory, since, until):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            payload = json.load(f)
+        if payload.get("version") != SEGMENT_VERSION:
+            logger.warning("Skip analytics segment %s of unknown version", path)
+            continue
+        columns = payload["columns"]
+        dims = {d: (columns[d]["codes"], columns[d]["dict"]) for d in DIMENSIONS}
+        yield columns["ts"], columns["user"], columns["step"]["codes"], columns["step"]["dict"], dims
+
+
+def step_counts(directory: str = ANALYTICS_DIR, since=None, until=None) -> dict[str, int]:
+    counts: dict[str, int] = {}
+    for ts, _, codes, dictionary, _ in read_segments(directory, since, until):
+        per_code = [0] * len(dictionary)
+        for t, code in zip(ts, codes):
+            if (since is None or t >= since) and (until is None or t < until):
+                per_code[code] += 1
+        for value, n in zip(dictionary, per_code):
+            counts[value] = counts.get(value, 0) + n
+    return counts
+
+
+def funnel_report(directory: str = ANALYTICS_DIR, by: str | None = None, since=None, until=None) -> dict:
+    """
+    {значение измерения: [пользователей на каждом шаге FUNNEL]}.
+
+    Пользователь относится к значению измерения, которое он выбрал последним
+    (например, к последнему выбранному городу); без разреза — всё под ключом "all".
+    """
+    if by is not None and by not in DIMENSIONS:
+        raise ValueError(f"unknown dimension {by!r}, expected one of {DIMENSIONS}")
+    funnel_index = {s: i for i, s in enumerate(FUNNEL)}
+    reached: dict[int, int] = {}      # user -> битовая маска пройденных шагов
+    dimension: dict[int, str] = {}    # user -> последнее значение измерения
+
+    for ts, users, codes, dictionary, dims in read_segments(directory, since, until):
+        bits = [1 << funnel_index[s] if s in funnel_index else 0 for s in dictionary]
+        dim_codes, dim_dict = dims[by] if by else ((), ())
+        for i, (t, user, code) in enumerate(zip(ts, users, codes)):
+            if user is None or (since is not None and t < since) or (until is not None and t >= until):
+                continue
+            if bits[code]:
+                reached[user] = reached.get(user, 0) | bits[code]
+            if by and dim_codes[i] >= 0:
+                dimension[user] = dim_dict[dim_codes[i]]
+
+    report: dict[str, list[int]] = {}
+    for user, mask in reached.items():
+        key = dimension.get(user, "—") if by else "all"
+        row = report.setdefault(key, [0] * len(FUNNEL))
+        for i in range(len(FUNNEL)):
+            if mask >> i & 1:
+                row[i] += 1
+    return report
+
+
+def print_funnel(report: dict, top: int):
+    rows = sorted(report.items(), key=lambda kv: kv[1][0], reverse=True)[:top]
+    width = max([len(k) for k, _ in rows] + [5])
+    print(f"{'':<{width}} " + " ".join(f"{s[:14]:>14}" for s in FUNNEL))
+    for key, counts in rows:
+        cells = [f"{counts[0]:>14}"]
+        for prev, cur in zip(counts, counts[1:]):
+            # Пользователи на шаге и доля от предыдущего шага
+            share = f"{cur / prev * 100:.0f}%" if prev else "-"
+            cells.append(f"{f'{cur} ({share})':>14}")
+        print(f"{key:<{width}} " + " ".join(cells))
+
+
+def _parse_date(value: str) -> int:
+    return int(datetime.strptime(value, "%Y-%m-%d").timestamp())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Funnel analytics over local event segments")
+    parser.add_argument("report", choices=("funnel", "steps"))
+    parser.add_argument("--by", choices=DIMENSIONS, help="split the funnel by a dimension")
+    parser.add_argument("--since", type=_parse_date, help="YYYY-MM-DD, inclusive")
+    parser.add_argument("--until", type=_parse_date, help="YYYY-MM-DD, exclusive")
+    parser.add_argument("--top", type=int, default=30, help="rows to show for --by")
+    parser.add_argument("--dir", default=ANALYTICS_DIR)
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    if args.report == "steps":
+        for step, n in sorted(step_counts(args.dir, args.since, args.until).items(), key=lambda kv: -kv[1]):
+            print(f"{step:<24} {n:>10}")
+    else:
+        print_funnel(funnel_report(args.dir, args.by, args.since, args.until), args.top)
+    print(f"\n({time.perf_counter() - started:.2f}s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""
+Офлайн-бенчмарк вебхука и всей воронки.
+
+Гоняет настоящий FastAPI `app` из bot.py через ASGI-транспорт httpx, без сети:
+Telegram Bot API и Google Sheets заменены заглушками из fakes.py с задержкой.
+
+    python bench.py                                  # матрица по умолчанию
+    python bench.py --users 100 1000 --cities 50 500
+    python bench.py --save baseline.json
+    python bench.py --baseline baseline.json         # сравнение с прошлым прогоном
+
+Каждая комбинация (users, cities) запускается в отдельном процессе,
+чтобы пиковый RSS не накапливался между прогонами.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import resource
+import subprocess
+
+BENCH_BOT_TOKEN = "123456:bench-token"
+BENCH_BOT_ID = 123456
+USER_ID_BASE = 10_000
+
+
+# ===============================
+# СИНТЕТИЧЕСКИЕ АПДЕЙТЫ
+# ===============================
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": "bench"}
+
+
+def message_update(update_id, user_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": _user(user_id),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+        },
+    }
+
+
+def callback_update(update_id, user_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": f"cq-{update_id}",
+            "from": _user(user_id),
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": 2,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": BENCH_BOT_ID, "is_bot": True, "first_name": "bot"},
+                "text": "bench",
+            },
+        },
+    }
+
+
+def funnel(cities: tuple) -> list[tuple[str, str]]:
+    from callbacks import encode, list_tag
+
+    # start → calc_income → age → citizenship → листание → первый город → доставка → заявка
+    return [
+        ("message", "/start"),
+        ("callback", encode("calc_income")),
+        ("callback", encode("age_yes")),
+        ("callback", encode("citizenship", "ru")),
+        ("callback", encode("cities_page", 1)),
+        ("callback", encode("cities_page", 0)),
+        ("callback", encode("city", list_tag(cities), 0)),
+        ("callback", encode("delivery", "foot")),
+        ("callback", encode("send_lead")),
+    ]
+
+
+# ===============================
+# ОДИН ПРОГОН
+# ===============================
+
+def _percentile_ms(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return round(sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))] * 1000, 2)
+
+
+async def run_single(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.environ["BOT_TOKEN"] = BENCH_BOT_TOKEN
+    os.environ["WEBHOOK_URL"] = "https://bench.invalid"
+    os.environ["WEBHOOK_MODE"] = args.mode
+    os.environ["FSM_STORAGE"] = args.fsm
+    os.environ["FSM_DB_PATH"] = os.path.join(workdir, "fsm.sqlite3")
+    os.environ["INCOME_CACHE_PATH"] = os.path.join(workdir, "income_cache.json")
+    os.environ["UPDATE_SPILL_PATH"] = os.path.join(workdir, "updates_spill.jsonl")
+    os.environ["LEADS_WAL_PATH"] = os.path.join(workdir, "leads.wal")
+    os.environ["ANALYTICS_DIR"] = os.path.join(workdir, "analytics")
+    # Бенчмарк сам шлёт апдейты быстрее живого пользователя — лимиты мерили бы не то
+    os.environ["THROTTLE_ENABLED"] = "0"
+    # Google и Telegram — локальные заглушки из fakes.py
+    os.environ["GOOGLE_BACKEND"] = "fake"
+    os.environ["TELEGRAM_BACKEND"] = "fake"
+    os.environ["FAKE_INCOME_CITIES"] = str(args.cities)
+
+    import httpx
+    import bot as bot_module
+    import fakes
+    from table_income import get_income_snapshot
+    from table_leads import LEADS_SPREADSHEET
+
+    google = fakes.get_fake_google_client()
+    google.faults = fakes.FaultInjector(args.sheets_latency, args.jitter, args.error_rate, seed=1)
+    session = bot_module.bot.session
+    session.faults = fakes.FaultInjector(args.telegram_latency, args.jitter, args.error_rate, seed=2)
+    app = bot_module.app
+
+    latencies = []
+    # В режиме queue вебхук отвечает до обработки — отдельно меряем путь апдейта
+    # от отправки до конца хендлера
+    sent_at = {}
+    e2e_latencies = []
+    update_ids = iter(range(1, 10**9))
+    feed_update = bot_module.dp.feed_update
+
+    async def timed_feed_update(bot, update, **kwargs):
+        try:
+            return await feed_update(bot, update, **kwargs)
+        finally:
+            e2e_latencies.append(time.perf_counter() - sent_at.pop(update.update_id))
+
+    bot_module.dp.feed_update = timed_feed_update
+
+    async def user_flow(client, user_id, steps):
+        for kind, payload in steps:
+            update_id = next(update_ids)
+            body = (message_update if kind == "message" else callback_update)(update_id, user_id, payload)
+            start = sent_at[update_id] = time.perf_counter()
+            resp = await client.post(f"/{BENCH_BOT_TOKEN}", json=body)
+            latencies.append(time.perf_counter() - start)
+            if resp.status_code != 200:
+                raise RuntimeError(f"webhook returned {resp.status_code}")
+
+    async with app.router.lifespan_context(app):
+        # Снимок доходов грузится из фейковой таблицы в фоне — ждём первую версию
+        while get_income_snapshot().version == 0:
+            await asyncio.sleep(0.01)
+        steps = funnel(bot_module.sorted_cities("rf"))
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            started = time.perf_counter()
+            await asyncio.gather(*(
+                user_flow(client, USER_ID_BASE + i, steps) for i in range(args.users)
+            ))
+            if bot_module.update_queue is not None:
+                await bot_module.update_queue.join()
+            elapsed = time.perf_counter() - started
+
+    # Лиды дописываются при выходе из lifespan
+    lead_rows = google.open(LEADS_SPREADSHEET).sheet1.row_count
+    latencies.sort()
+    e2e_latencies.sort()
+    total = len(latencies)
+    return {
+        "users": args.users,
+        "cities": args.cities,
+        "mode": args.mode,
+        "fsm": args.fsm,
+        "updates": total,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(total / elapsed, 1),
+        # p50/p99 — ответ вебхука, e2e — до конца обработки апдейта
+        "p50_ms": _percentile_ms(latencies, 0.5),
+        "p99_ms": _percentile_ms(latencies, 0.99),
+        "e2e_p50_ms": _percentile_ms(e2e_latencies, 0.5),
+        "e2e_p99_ms": _percentile_ms(e2e_latencies, 0.99),
+        # ru_maxrss в Linux — в килобайтах
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "telegram_calls": sum(session.calls.values()),
+        "injected_errors": session.faults.errors + google.faults.errors,
+        "lead_rows": lead_rows,
+    }
+
+
+# ===============================
+# МАТРИЦА ПРОГОНОВ
+# ===============================
+
+def run_matrix(args) -> list[dict]:
+    results = []
+    for users in args.users:
+        for cities in args.cities:
+            cmd = [
+                sys.executable, __file__, "--single",
+                "--users", str(users), "--cities", str(cities),
+                "--mode", args.mode, "--fsm", args.fsm,
+                "--telegram-latency", str(args.telegram_latency),
+                "--sheets-latency", str(args.sheets_latency),
+                "--jitter", str(args.jitter), "--error-rate", str(args.error_rate),
+            ]
+            out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(out.strip().splitlines()[-1]))
+    return results
+
+
+def print_table(results, baseline=None):
+    base = {(r["users"], r["cities"], r["mode"]): r for r in baseline or []}
+    header = (
+        f"{'users':>7} {'cities':>7} {'mode':>6} {'upd/s':>9} {'p50 ms':>8} {'p99 ms':>8} "
+        f"{'e2e p50':>8} {'e2e p99':>8} {'rss MB':>7} {'tg calls':>9}"
+    )
+    print(header)
+    for r in results:
+        line = (
+            f"{r['users']:>7} {r['cities']:>7} {r['mode']:>6} {r['updates_per_s']:>9} "
+            f"{r['p50_ms']:>8} {r['p99_ms']:>8} {r.get('e2e_p50_ms', '-'):>8} {r.get('e2e_p99_ms', '-'):>8} "
+            f"{r['peak_rss_mb']:>7} {r['telegram_calls']:>9}"
+        )
+        prev = base.get((r["users"], r["cities"], r["mode"]))
+        if prev:
+            delta = (r["updates_per_s"] - prev["updates_per_s"]) / prev["updates_per_s"] * 100
+            line += f"   ({delta:+.1f}% upd/s vs baseline)"
+        print(line)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline webhook/funnel benchmark")
+    parser.add_argument("--users", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--cities", type=int, nargs="+", default=[50, 500])
+    parser.add_argument("--mode", choices=("queue", "sync"), default="queue")
+    parser.add_argument("--fsm", choices=("sqlite", "memory"), default="sqlite")
+    parser.add_argument("--telegram-latency", type=float, default=5.0, help="ms per Bot API call")
+    parser.add_argument("--sheets-latency", type=float, default=50.0, help="ms per Sheets call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="± ms of random jitter")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls failing with 429")
+    parser.add_argument("--save", help="write results to a JSON file")
+    parser.add_argument("--baseline", help="compare with results saved by --save")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.single:
+        args.users, args.cities = args.users[0], args.cities[0]
+        print(json.dumps(asyncio.run(run_single(args))))
+        return
+
+    results = run_matrix(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_table(results, baseline)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
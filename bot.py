@@ -1,22 +1,56 @@
+import startup_report  # noqa: F401 — должен импортироваться первым, чтобы замерить остальные импорты
 import os
+import asyncio
+import logging
 from fastapi import FastAPI, Request
-from aiogram import Bot, Dispatcher, types
+from fastapi.responses import JSONResponse, PlainTextResponse
+from aiogram import Bot, Dispatcher, F, types
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Update
-from aiogram.filters import CommandStart
-from aiogram.fsm.storage.memory import MemoryStorage
+import screens
+from callbacks import CallbackRouter, decode, encode, list_tag
+from aiogram.filters import Command, CommandStart
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
-from aiogram.exceptions import TelegramBadRequest
 import uvicorn
-from table_leads import save_lead
-from table_income import get_average_income
-
+from table_leads import get_queue_depth, get_spreadsheet_id, save_lead, start_lead_worker, stop_lead_worker
+from fsm_storage import create_storage
+from idempotency import DedupMiddleware
+from throttling import ThrottleMiddleware
+from edit_dispatcher import EditDispatcher
+import metrics
+import analytics
+from metrics import MetricsMiddleware, step
+from update_queue import WEBHOOK_MODE, UpdateQueue
+from google_client import close_sheets_clients, sheets_breaker
+from workers import WORKERS, is_multi_worker, try_become_leader
+from table_income import estimate_income, format_money, get_cities, get_income_snapshot, search_cities, shift_estimates, init_income_service, request_income_refresh, stop_income_service
+
+
+metrics.setup_logging()
+logger = logging.getLogger(__name__)
+startup_report.mark("imports")
 
 BOT_TOKEN = os.environ["BOT_TOKEN"]
 WEBHOOK_URL = os.environ["WEBHOOK_URL"]
-
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+ADMIN_IDS = {int(x) for x in os.environ.get("ADMIN_IDS", "").split(",") if x.strip()}
+# real | fake — фейковый Bot API из fakes.py для нагрузочных тестов без сети
+TELEGRAM_BACKEND = os.environ.get("TELEGRAM_BACKEND", "real")
+
+if TELEGRAM_BACKEND == "fake":
+    from fakes import create_fake_telegram_session
+    bot = Bot(token=BOT_TOKEN, session=create_fake_telegram_session())
+else:
+    bot = Bot(token=BOT_TOKEN)
+dp = Dispatcher(storage=create_storage())
+# Ретраи вебхука и двойные нажатия отсекаются до хендлеров
+dedup = DedupMiddleware()
+dp.update.outer_middleware(dedup)
+# Флуд от одного пользователя и всплески сверх общего лимита отбрасываются до фильтров и FSM
+throttle = ThrottleMiddleware()
+dp.message.outer_middleware(throttle)
+dp.callback_query.outer_middleware(throttle)
+dp.message.middleware(MetricsMiddleware())
+dp.callback_query.middleware(MetricsMiddleware())
 
 # ===============================
 # КОНСТАНТЫ
@@ -67,132 +101,117 @@ class Form(StatesGroup):
 # ===============================
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # ===============================
+# Все правки идут через диспетчер: пропуск повторов, схлопывание и лимиты Telegram.
+# Правка уходит в фоне — хендлер не ждёт её отправки
+edits = EditDispatcher()
+
 async def safe_edit(message, text, **kwargs):
-    try:
-        await message.edit_text(text, **kwargs)
-    except TelegramBadRequest as e:
-        if any(x in str(e) for x in (
-            "message is not modified",
-            "message can't be edited"
-        )):
-            pass
-        else:
-            raise
+    await edits.edit_text(message, text, **kwargs)
 
-async def safe_edit_markup(message, reply_markup):
-    try:
-        await message.edit_reply_markup(reply_markup=reply_markup)
-    except TelegramBadRequest as e:
-        if any(x in str(e) for x in (
-            "message is not modified",
-            "message can't be edited"
-        )):
-            pass
-        else:
-            raise
-
-def filter_cities_by_citizenship(records, citizenship_type):
-    cities = set()
-    for r in records:
-        if citizenship_type == "rf":
-            cities.add(r["city"])
-        elif citizenship_type == "eaes" and r["eaes"] == "TRUE":
-            cities.add(r["city"])
-        elif citizenship_type == "not_rf" and r["not_rf"] == "TRUE":
-            cities.add(r["city"])
-    return sorted(cities)
-
-def income_keyboard():
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(
-                text="📝 Хочу откликнуться",
-                callback_data="send_lead"
-            )],
-            [
-                InlineKeyboardButton(
-                    text="🎁 Бонусы для курьеров",
-                    callback_data="income_bonus"
-                ),
-                InlineKeyboardButton(
-                    text="❓ Частые вопросы",
-                    callback_data="income_faq"
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    text="🔄 Рассчитать ещё раз",
-                    callback_data="income_recalc"
-                )
-            ]
-        ]
-    )
+async def show(message, screen):
+    await safe_edit(message, screen.text, **screen.options)
 
+async def safe_edit_markup(message, reply_markup):
+    await edits.edit_markup(message, reply_markup)
 
 def sort_cities(top, all_cities):
-    top_part = [c for c in top if c in all_cities]
-    rest = sorted(c for c in all_cities if c not in top_part)
-    return top_part + rest
-
-def back_to_age_keyboard():
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="⬅ Назад", callback_data="back_to_age")]
-        ]
-    )
+    available = set(all_cities)
+    top_part = [c for c in top if c in available]
+    top_set = set(top_part)
+    rest = sorted(c for c in available if c not in top_set)
+    return tuple(top_part + rest)
 
 def cities_keyboard(cities, page=0, per_page=10):
     start = page * per_page
     end = start + per_page
+    # В кнопке — индекс города и метка списка, а не название: короче и не упирается в 64 байта
+    tag = list_tag(cities)
 
     keyboard = []
 
-    for city in cities[start:end]:
+    for index, city in enumerate(cities[start:end], start):
         keyboard.append([
-            InlineKeyboardButton(text=city, callback_data=f"city_{city}")
+            InlineKeyboardButton(text=city, callback_data=encode("city", tag, index))
         ])
 
     nav = []
     if page > 0:
         nav.append(
-            InlineKeyboardButton(text="⬅ Назад", callback_data=f"cities_page_{page-1}")
+            InlineKeyboardButton(text="⬅ Назад", callback_data=encode("cities_page", page - 1))
         )
     if end < len(cities):
         nav.append(
-            InlineKeyboardButton(text="➡ Далее", callback_data=f"cities_page_{page+1}")
+            InlineKeyboardButton(text="➡ Далее", callback_data=encode("cities_page", page + 1))
         )
 
     if nav:
         keyboard.append(nav)
 
     keyboard.append([
-        InlineKeyboardButton(text="❌ Нет моего города", callback_data="no_city")
+        InlineKeyboardButton(text="❌ Нет моего города", callback_data=encode("no_city"))
     ])
 
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
-def citizenship_keyboard():
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="🇷🇺 Россия", callback_data="citizenship_ru")],
-            [InlineKeyboardButton(text="🇧🇾 Беларусь", callback_data="citizenship_by")],
-            [InlineKeyboardButton(text="🇰🇿 Казахстан", callback_data="citizenship_kz")],
-            [InlineKeyboardButton(text="🇦🇲 Армения", callback_data="citizenship_am")],
-            [InlineKeyboardButton(text="🇰🇬 Кыргызстан", callback_data="citizenship_kg")],
-            [InlineKeyboardButton(text="Другое", callback_data="citizenship_other")],
-        ]
-    )
+# 🔹 Кэш списков городов и клавиатур. Привязан к версии снимка доходов:
+# при обновлении таблицы версия меняется, и кэш собирается заново
+_cities_cache = {}
+_keyboards_cache = {}
+_positions_cache = {}
+_cache_version = None
+
+
+def _check_cache_version(version):
+    global _cache_version
+    if version != _cache_version:
+        _cities_cache.clear()
+        _keyboards_cache.clear()
+        _positions_cache.clear()
+        _cache_version = version
+
+
+def sorted_cities(citizenship_type):
+    version = get_income_snapshot().version
+    _check_cache_version(version)
+    cities = _cities_cache.get(citizenship_type)
+    if cities is None:
+        cities = sort_cities(TOP_CITIES, get_cities(citizenship_type))
+        _cities_cache[citizenship_type] = cities
+    return cities
+
+
+def city_position(citizenship_type, city):
+    # Индекс города в отсортированном списке — его кладём в callback_data
+    sorted_cities(citizenship_type)
+    positions = _positions_cache.get(citizenship_type)
+    if positions is None:
+        positions = {c: i for i, c in enumerate(sorted_cities(citizenship_type))}
+        _positions_cache[citizenship_type] = positions
+    return positions.get(city)
+
+
+def city_matches_keyboard(citizenship_type, matches):
+    tag = list_tag(sorted_cities(citizenship_type))
+    keyboard = [
+        [InlineKeyboardButton(text=city, callback_data=encode("city", tag, city_position(citizenship_type, city)))]
+        for city in matches
+    ]
+    keyboard.append([InlineKeyboardButton(text="📋 Весь список", callback_data=encode("cities_page", 0))])
+    keyboard.append([InlineKeyboardButton(text="❌ Нет моего города", callback_data=encode("no_city"))])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
-def delivery_keyboard():
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="🧍 Пешком", callback_data="delivery_foot")],
-            [InlineKeyboardButton(text="🚲 Вело", callback_data="delivery_bike")],
-            [InlineKeyboardButton(text="🚗 Авто", callback_data="delivery_car")],
-        ]
-    )
+def cached_cities_keyboard(citizenship_type, page=0):
+    cities = sorted_cities(citizenship_type)
+    # Страница из callback_data — не даём раздувать кэш несуществующими страницами
+    page = max(0, min(page, (len(cities) - 1) // 10))
+    key = (citizenship_type, page, _cache_version)
+    keyboard = _keyboards_cache.get(key)
+    if keyboard is None:
+        keyboard = cities_keyboard(cities, page)
+        _keyboards_cache[key] = keyboard
+    return keyboard
 
 
 # ===============================
@@ -201,269 +220,194 @@ def delivery_keyboard():
 
 @dp.message(CommandStart())
 async def render_start(message: types.Message):
-    print("[STEP] Перешёл на стартовый экран")
-    text = (
-        "👋 Привет!\n\n"
-        "Я информационный бот о работе курьером доставки еды.\n\n"
-        "Могу рассказать про:\n"
-        "• условия работы\n"
-        "• требования\n"
-        "• формат занятости\n"
-        "• примерный доход в вашем городе\n\n"
-        "Выберите, что хотите посмотреть 👇"
-    )
-
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="📋 Условия работы", callback_data="info_conditions")],
-            [InlineKeyboardButton(text="🛂 Требования", callback_data="info_requirements")],
-            [InlineKeyboardButton(text="💰 Примерный доход", callback_data="calc_income")]
-        ]
-    )
-
-    await message.answer(text, reply_markup=keyboard)
+    step("start")
+    await message.answer(screens.START.text, **screens.START.options)
+
+# Все callback-и проходят через один хендлер: декодируем callback_data и находим
+# обработчик по (действию, состоянию) в таблице. Состояние FSM aiogram уже прочитал
+# для этого апдейта (raw_state) — хендлеры не запрашивают его повторно
+callback_router = CallbackRouter()
+
+@dp.callback_query()
+async def route_callback(callback: types.CallbackQuery, state: FSMContext, raw_state: str | None):
+    action, args = decode(callback.data)
+    handler = callback_router.resolve(action, raw_state)
+    if handler is None:
+        # Кнопка из другого шага или устаревшей клавиатуры
+        await callback.answer()
+        return
+    # В метриках — настоящий хендлер, а не общая точка входа
+    metrics.current_handler.set(handler.__name__)
+    await handler(callback, state, *args)
 
-@dp.callback_query(lambda c: c.data in ["info_conditions", "info_requirements"])
+@callback_router.route("info_conditions")
+@callback_router.route("info_requirements")
 async def info_buttons(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
-    
-    if callback.data == "info_conditions":
-        print("[STEP] Перешёл на экран 'Условия работы'")
-        text = (
-            "📋 <b>Условия работы курьером</b>\n\n"
-            "• Гибкий график — выбираете в какой день и сколько часов работать\n"
-            "• Можно совмещать с учёбой или основной работой по ТК РФ, оформление через самозанятость или ГПХ\n"
-            "• Форматы доставки: пешком, вело или авто\n"
-            "• Работа с заказами через приложение\n\n"
-            "Доход зависит от города, количества заказов и формата доставки."
-        )
-        buttons = [
-            [InlineKeyboardButton(text="💰 Посмотреть доход", callback_data="calc_income")],
-            [InlineKeyboardButton(text="⬅ Назад", callback_data="back_to_start")]
-        ]
-    else:  # info_requirements
-        print("[STEP] Перешёл на экран 'Требования'")
-        text = (
-            "🛂 <b>Требования</b>\n\n"
-            "• Возраст от 18 лет\n"
-            "• Знание русского языка\n"
-            "• Смартфон Android (версия не ниже 7.0) или iOS (версия не ниже 13.0) для работы с заказами\n"
-            "• Умение пользоваться навигатором \n\n"
-            "Точные условия зависят от города."
-        )
-        buttons = [
-            [InlineKeyboardButton(text="💰 Рассчитать доход", callback_data="calc_income")],
-            [InlineKeyboardButton(text="⬅ Назад", callback_data="back_to_start")]
-        ]
-    
-    # Используем edit_message_text — редактируем **нажатое сообщение**
-    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+
+    action, _ = decode(callback.data)
+    step(action)
+    screen = screens.SCREENS_BY_CALLBACK[action]
+
+    # Редактируем **нажатое сообщение**
+    await show(callback.message, screen)
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "back_to_start")
+@callback_router.route("back_to_start")
 async def back_to_start(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
-    text = (
-        "👋 Привет!\n\n"
-        "Я информационный бот о работе курьером доставки еды.\n\n"
-        "Могу рассказать про:\n"
-        "• условия работы\n"
-        "• требования\n"
-        "• формат занятости\n"
-        "• примерный доход в вашем городе\n\n"
-        "Выберите, что хотите посмотреть 👇"
-    )
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="📋 Условия работы", callback_data="info_conditions")],
-            [InlineKeyboardButton(text="🛂 Требования", callback_data="info_requirements")],
-            [InlineKeyboardButton(text="💰 Примерный доход", callback_data="calc_income")]
-        ]
-    )
-    await callback.message.edit_text(text, reply_markup=keyboard)
+    await show(callback.message, screens.START)
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "calc_income")
+@callback_router.route("calc_income")
 async def calc_income_entry(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
+    step("calc_income")
 
-    await safe_edit(
-        callback.message,
-        "Чтобы рассчитать примерный доход, уточним несколько деталей.\n\n"
-        "Вам есть 18 лет?",
-        reply_markup=InlineKeyboardMarkup(
-            inline_keyboard=[
-                [
-                    InlineKeyboardButton(text="Да✅", callback_data="age_yes"),
-                    InlineKeyboardButton(text="Нет❌", callback_data="age_no")
-                ]
-            ]
-        )
-    )
+    await show(callback.message, screens.AGE_QUESTION)
 
     await state.set_state(Form.waiting_for_age)
     await callback.answer()
 
-@dp.callback_query(Form.waiting_for_age, lambda c: c.data in ("age_yes", "age_no"))
+@callback_router.route("age_no", Form.waiting_for_age)
+async def age_under_18(callback: types.CallbackQuery, state: FSMContext):
+    step("age_under_18")
+    await show(callback.message, screens.UNDERAGE)
+    await state.set_state(Form.waiting_for_underage)
+    await callback.answer()
+
+@callback_router.route("age_yes", Form.waiting_for_age)
 async def age_answer(callback: types.CallbackQuery, state: FSMContext):
-    if await state.get_state() != Form.waiting_for_age:
-        await callback.answer()
-        return
-    if callback.data == "age_no":
-        print("[STEP] Ответил 'Нет, меньше 18'")
-        await safe_edit(
-    callback.message,
-            "Если тебе есть 16 лет, ты можешь работать курьером в некоторых городах:\n"
-            "<b>Нижний Новгород, Самара, Ростов-на-Дону, Челябинск, Тверь, Сургут, Тюмень, Астрахань, Владивосток, Томск, Иваново, Сочи, Ставрополь, Ижевск, Калуга, Липецк, Барнаул, Сергиев Посад, Нижнекамск, Красноярск, Воронеж, Екатеринбург, Казань, Новороссийск, Тула, Набережные Челны, Ульяновск, Москва+МО, Санкт-Петербург+ЛО</b>\n\n"
-            "Для оформления потребуется <b>свидетельство о рождении</b> и <b>согласие родителей</b>.\n\n",
-            parse_mode="HTML",
-            reply_markup=back_to_age_keyboard()
-        )
-        await state.set_state(Form.waiting_for_underage)
-        await callback.answer()
-        return
-    print("[STEP] Ответил 'Да, есть 18+'")
-    await safe_edit(
-    callback.message,
-        "Выберите ваше гражданство",
-        reply_markup=citizenship_keyboard()
-    )
+    step("age_18_plus")
+    await show(callback.message, screens.CITIZENSHIP)
     await state.set_state(Form.waiting_for_citizenship)
-    print("[STEP] Перешёл на экран выбора гражданства")
     await callback.answer()
 
-@dp.callback_query(Form.waiting_for_underage, lambda c: c.data == "back_to_age")
+@callback_router.route("back_to_age", Form.waiting_for_underage)
 async def back_to_age(callback: types.CallbackQuery, state: FSMContext):
-    await safe_edit(
-    callback.message,
-        "Чтобы рассчитать примерный доход, уточним несколько деталей.\n\n"
-        "Вам есть 18 лет?",
-        reply_markup=InlineKeyboardMarkup(
-            inline_keyboard=[
-                [
-                    InlineKeyboardButton(text="Да✅", callback_data="age_yes"),
-                    InlineKeyboardButton(text="Нет❌", callback_data="age_no")
-                ]
-            ]
-        )
-    )
+    await show(callback.message, screens.AGE_QUESTION)
 
     await state.set_state(Form.waiting_for_age)
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "back_to_start_after_lead")
-async def back_to_start_after_lead(callback: types.CallbackQuery):
-    text = (
-        "Вы снова в меню бота. Могу рассказать про:\n"
-        "• условия работы\n"
-        "• требования\n"
-        "• примерный доход в вашем городе\n\n"
-        "Выберите опцию 👇"
-    )
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="📋 Условия работы", callback_data="info_conditions")],
-            [InlineKeyboardButton(text="🛂 Требования", callback_data="info_requirements")],
-            [InlineKeyboardButton(text="💰 Примерный доход", callback_data="calc_income")]
-        ]
-    )
-
-    await safe_edit(
-        callback.message,
-        text,
-        reply_markup=keyboard
-    )
+@callback_router.route("back_to_start_after_lead")
+async def back_to_start_after_lead(callback: types.CallbackQuery, state: FSMContext):
+    await show(callback.message, screens.MENU_AFTER_LEAD)
     await callback.answer()
 
 # ===============================
 # ГРАЖДАНСТВО → ГОРОДА
 # ===============================
 
-@dp.callback_query(Form.waiting_for_citizenship)
-async def citizenship_chosen(callback: types.CallbackQuery, state: FSMContext):
-    citizenship_map = {
-        "citizenship_ru": "Россия",
-        "citizenship_by": "Беларусь",
-        "citizenship_kz": "Казахстан",
-        "citizenship_am": "Армения",
-        "citizenship_kg": "Кыргызстан",
-        "citizenship_other": "Другое",
-    }
-
-    citizenship = citizenship_map.get(callback.data)
+CITIZENSHIP_BY_CODE = {
+    "ru": "Россия",
+    "by": "Беларусь",
+    "kz": "Казахстан",
+    "am": "Армения",
+    "kg": "Кыргызстан",
+    "other": "Другое",
+}
+
+@callback_router.route("citizenship", Form.waiting_for_citizenship)
+async def citizenship_chosen(callback: types.CallbackQuery, state: FSMContext, code: str):
+    citizenship = CITIZENSHIP_BY_CODE.get(code)
     if not citizenship:
         await callback.answer()
         return
 
     citizenship_type = CITIZENSHIP_TYPE_MAP[citizenship]
-    records = get_average_income()
-
-    cities = filter_cities_by_citizenship(records, citizenship_type)
-    cities = sort_cities(TOP_CITIES, cities)
-
+    if get_income_snapshot().version == 0:
+        # Ни кэша на диске, ни ответа от Google — данные ещё грузятся
+        await callback.answer("Загружаем список городов, попробуйте через минуту", show_alert=True)
+        return
+    step("citizenship_chosen", citizenship=citizenship)
+    # В FSM кладём только версию данных, а не весь список городов
     await state.update_data(
         citizenship=citizenship,
         citizenship_type=citizenship_type,
-        cities=cities
+        cities_version=get_income_snapshot().version
     )
 
     await safe_edit(
     callback.message,
-        "В каком городе вы планируете выполнять доставки?\nВыберите:",
-        reply_markup=cities_keyboard(cities, page=0)
+        screens.CITY_PROMPT_TEXT,
+        reply_markup=cached_cities_keyboard(citizenship_type, page=0)
     )
 
     await state.set_state(Form.waiting_for_city)
     await callback.answer()
 
 
-@dp.callback_query(Form.waiting_for_city, lambda c: c.data.startswith("cities_page_"))
-async def cities_pagination(callback: types.CallbackQuery, state: FSMContext):
-    print("[STEP] Листает список городов")
-    if await state.get_state() != Form.waiting_for_city:
+@callback_router.route("cities_page", Form.waiting_for_city)
+async def cities_pagination(callback: types.CallbackQuery, state: FSMContext, page: str):
+    if not page.isdigit():
         await callback.answer()
         return
-    page = int(callback.data.split("_")[-1])
+    page = int(page)
+    step("cities_page", page=page)
     data = await state.get_data()
-    cities = data.get("cities")
-    if not cities:
+    citizenship_type = data.get("citizenship_type")
+    if not citizenship_type or "cities_version" not in data:
         await callback.answer("Сценарий устарел. Нажмите /start", show_alert=True)
         return
-    await safe_edit_markup(callback.message, cities_keyboard(cities, page)
+    await safe_edit_markup(callback.message, cached_cities_keyboard(citizenship_type, page)
     )
     await callback.answer()
 
 
-@dp.callback_query(Form.waiting_for_city, lambda c: c.data.startswith("city_"))
-async def city_chosen(callback: types.CallbackQuery, state: FSMContext):
-    print("[STEP] Перешёл на экран выбора города")
-    if await state.get_state() != Form.waiting_for_city:
-        await callback.answer()
+@callback_router.route("city", Form.waiting_for_city)
+async def city_chosen(callback: types.CallbackQuery, state: FSMContext, tag: str, index: str):
+    data = await state.get_data()
+    citizenship_type = data.get("citizenship_type")
+    if not citizenship_type:
+        await callback.answer("Сценарий устарел. Нажмите /start", show_alert=True)
+        return
+    cities = sorted_cities(citizenship_type)
+    if tag != list_tag(cities) or not index.isdigit() or int(index) >= len(cities):
+        # Таблица обновилась после показа клавиатуры — индексы уже другие
+        await safe_edit_markup(callback.message, cached_cities_keyboard(citizenship_type, 0))
+        await callback.answer("Список городов обновился, выберите город ещё раз", show_alert=True)
         return
-    city = callback.data.replace("city_", "")
+    city = cities[int(index)]
+    step("city_chosen", city=city)
     await state.update_data(city=city)
 
-    await safe_edit(
-    callback.message,
-        "Остался последний вопрос — и покажу доход\n"
-        "Какой формат доставки вам подходит?",
-        reply_markup=delivery_keyboard()
-    )
+    await show(callback.message, screens.DELIVERY)
 
     await state.set_state(Form.waiting_for_delivery)
     await callback.answer()
 
 
-@dp.callback_query(Form.waiting_for_city, lambda c: c.data == "no_city")
-async def no_city(callback: types.CallbackQuery, state: FSMContext):
-    await safe_edit(
-    callback.message,
-        "К сожалению, в вашем городе пока нет найма 😔"
+@dp.message(Form.waiting_for_city, F.text)
+async def city_search(message: types.Message, state: FSMContext):
+    # Вместо листания по 10 городов — поиск по введённому тексту (опечатки, ё/е, раскладка)
+    data = await state.get_data()
+    citizenship_type = data.get("citizenship_type")
+    if not citizenship_type:
+        await message.answer("Сценарий устарел. Нажмите /start")
+        return
+    matches = search_cities(message.text[:100], citizenship_type)
+    step("city_search", found=len(matches))
+    if not matches:
+        await message.answer(
+            screens.CITY_NOT_FOUND_TEXT,
+            reply_markup=cached_cities_keyboard(citizenship_type, page=0)
+        )
+        return
+    await message.answer(
+        screens.CITY_SEARCH_TEXT,
+        reply_markup=city_matches_keyboard(citizenship_type, matches)
     )
+
+
+@callback_router.route("no_city", Form.waiting_for_city)
+async def no_city(callback: types.CallbackQuery, state: FSMContext):
+    step("no_city")
+    await show(callback.message, screens.NO_CITY)
     await state.clear()
     await callback.answer()
 
-@dp.callback_query(Form.waiting_for_delivery, lambda c: c.data == "send_lead")
+@callback_router.route("send_lead", Form.waiting_for_delivery)
 async def send_lead(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
 
@@ -477,38 +421,14 @@ async def send_lead(callback: types.CallbackQuery, state: FSMContext):
 
     user = callback.from_user
     await state.update_data(lead_sent=True)
-    save_lead({
+    await save_lead({
         **data,
         "user_id": user.id,
         "username": user.username
     })
 
-    # Клавиатура с кнопкой регистрации и возвратом в начало
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(
-                    text="📝 Заполнить анкету",
-                    url="https://reg.eda.yandex.ru/?advertisement_campaign=forms_for_agents&user_invite_code=4fd8c46d41724e86a4448b0367951ddb&utm_content=blank"
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    text="⬅ Вернуться в начало",
-                    callback_data="back_to_start_after_lead"
-                )
-            ]
-        ]
-    )
-
-    await safe_edit(
-        callback.message,
-        "Двигаемся дальше 😊\n\n"
-        "➡️ Следующий шаг — короткая анкета и мини-обучение по работе с заказами.\n"
-        "Ничего сложного, обычно занимает 15 минут.\n",
-        parse_mode="HTML",
-        reply_markup=keyboard
-    )
+    step("lead_sent", city=data.get("city"))
+    await show(callback.message, screens.LEAD_SENT)
 
     await state.clear()
     await callback.answer()
@@ -516,153 +436,216 @@ async def send_lead(callback: types.CallbackQuery, state: FSMContext):
 # ДОХОД И КНОПКИ
 # ===============================
 
-# 🔹 Заменяем оба старых коллбэка delivery_chosen и income_buttons этим
-@dp.callback_query(Form.waiting_for_delivery, lambda c: c.data.startswith("delivery_") or c.data in ["income_bonus", "income_faq", "income_recalc"])
-async def income_flow(callback: types.CallbackQuery, state: FSMContext):
-    if await state.get_state() != Form.waiting_for_delivery:
-        await callback.answer()
-        return
+ESTIMATE_NOTES = {
+    "other_delivery": "ℹ️ По этому формату в вашем городе данных нет — оценка по другим форматам доставки в нём.",
+    "nearest": "ℹ️ По вашему городу данных нет — оценка по ближайшему городу: {basis}.",
+    "region": "ℹ️ По вашему городу данных нет — оценка по региону: {basis}.",
+    "country": "ℹ️ По вашему городу данных нет — оценка по средним данным по стране.",
+}
+
+def income_text(city, citizenship, delivery, est, shifts=None):
+    payout = "Выплаты: ежедневные" if citizenship in DAILY_PAYOUT_CITIZENSHIPS else "Выплаты: еженедельно"
+    legal = "Оформление через партнёра сервиса — самозанятость" if citizenship in DAILY_PAYOUT_CITIZENSHIPS else "Оформление по договору через партнёра сервиса"
+    if shifts:
+        month_line = f"• В месяц при {shifts} сменах в неделю: {format_money(int(shift_estimates(est.day, shifts)))} ₽\n"
+    else:
+        month_line = f"• В месяц: {est.month_avg_text} ₽\n"
+    note = ESTIMATE_NOTES.get(est.source)
+
+    doc_text = DOCUMENTS_BY_CITIZENSHIP.get(citizenship)
+    return (
+        f"📍 Город: {city}\n\n"
+        f"⚠️ Эти цифры приведены для ориентира и могут различаться в зависимости от количества смен, заказов и выбранного формата работы.\n\n"
+        + (f"{note.format(basis=est.basis)}\n\n" if note else "")
+        + f"💵 Примерный доход курьера ({DELIVERY_TITLES[delivery]}, средний):\n"
+        f"• В день: {est.day_text} ₽\n"
+        + month_line
+        + f"• Максимум в месяц: {est.month_max_text} ₽\n"
+        f"📊 Обычно в этом формате по стране: {format_money(est.band_low)}–{format_money(est.band_high)} ₽ в день\n\n"
+        f"{payout}\n"
+        f"{legal}\n\n"
+        f"📝 <b>Документы для оформления:</b>\n"
+        f"{doc_text}"
+    )
+
+@callback_router.route("delivery", Form.waiting_for_delivery)
+async def income_flow(callback: types.CallbackQuery, state: FSMContext, delivery: str):
     data = await state.get_data()
     if not data or "city" not in data or "citizenship" not in data:
         await callback.answer("Сценарий устарел. Нажмите /start", show_alert=True)
         return
-    # Если выбрали формат доставки
-    if callback.data.startswith("delivery_"):
-        print("[STEP] Перешёл на экран выбора формата доставки и расчёта дохода")
-        delivery_map = {
-            "delivery_foot": "foot",
-            "delivery_bike": "bike",
-            "delivery_car": "car",
-        }
-        delivery = delivery_map.get(callback.data)
-        if not delivery:
-            await callback.answer()
-            return
-
-        city = data["city"]
-        citizenship = data["citizenship"]
-
-        records = get_average_income()
-        rec = next((r for r in records if r["city"] == city and r["delivery"] == delivery), None)
-
-        if not rec:
-            await callback.answer("Нет данных по выбранному формату", show_alert=True)
-            await state.clear()
-            return
-        payout = "Выплаты: ежедневные" if citizenship in DAILY_PAYOUT_CITIZENSHIPS else "Выплаты: еженедельно"
-        legal = "Оформление через партнёра сервиса — самозанятость" if citizenship in DAILY_PAYOUT_CITIZENSHIPS else "Оформление по договору через партнёра сервиса"
-
-        # 🔹 Форматируем числа с пробелами
-        day_income = f"{int(rec['day']):,}".replace(",", " ")
-        month_avg_income = f"{int(rec['month_avg']):,}".replace(",", " ")
-        month_max_income = f"{int(rec['month_max']):,}".replace(",", " ")
-
-        # 🔹 СОХРАНЯЕМ В FSM (ВОТ ЭТО ДОБАВЛЯЕМ 👇)
-        await state.update_data(
-            delivery=DELIVERY_TITLES[delivery],
-            day_income=day_income,
-            month_avg=month_avg_income,
-            month_max=month_max_income
-        )
+    if delivery not in DELIVERY_TITLES:
+        await callback.answer()
+        return
 
-        doc_text = DOCUMENTS_BY_CITIZENSHIP.get(citizenship)
-        text = (
-            f"📍 Город: {city}\n\n"
-            f"⚠️ Эти цифры приведены для ориентира и могут различаться в зависимости от количества смен, заказов и выбранного формата работы.\n\n"
-            f"💵 Примерный доход курьера ({DELIVERY_TITLES[delivery]}, средний):\n"
-            f"• В день: {day_income} ₽\n"
-            f"• В месяц: {month_avg_income} ₽\n"
-            f"• Максимум в месяц: {month_max_income} ₽\n\n"
-            f"{payout}\n"
-            f"{legal}\n\n"
-            f"📝 <b>Документы для оформления:</b>\n"
-            f"{doc_text}"
-        )
+    city = data["city"]
+    citizenship = data["citizenship"]
+
+    # Точной строки может не быть — тогда оценка по другим форматам, соседям, региону или стране
+    est = estimate_income(city, delivery)
+    step("income_shown", city=city, delivery=delivery, source=est.source if est else "none")
+
+    if not est:
+        # Таблица пуста для этого формата целиком — даём выбрать другой
+        await callback.answer("Нет данных по выбранному формату", show_alert=True)
+        return
+
+    # 🔹 СОХРАНЯЕМ В FSM (ВОТ ЭТО ДОБАВЛЯЕМ 👇)
+    await state.update_data(
+        delivery=DELIVERY_TITLES[delivery],
+        delivery_code=delivery,
+        day_income=est.day_text,
+        month_avg=est.month_avg_text,
+        month_max=est.month_max_text
+    )
 
-        # 🔹 Показываем доход с клавиатурой бонусов/FAQ/расчёта
-        await safe_edit(
+    # 🔹 Показываем доход с клавиатурой смен/бонусов/FAQ/расчёта
+    await safe_edit(
     callback.message,
-            text,
-            parse_mode="HTML",
-            reply_markup=income_keyboard()
-        )
-        await state.set_state(Form.waiting_for_delivery)
+        income_text(city, citizenship, delivery, est),
+        parse_mode="HTML",
+        reply_markup=screens.INCOME_RESULT_KEYBOARD
+    )
+    await callback.answer()
+
+
+@callback_router.route("shifts", Form.waiting_for_delivery)
+async def income_shifts(callback: types.CallbackQuery, state: FSMContext, shifts: str):
+    data = await state.get_data()
+    delivery = data.get("delivery_code")
+    if not delivery or "city" not in data or not shifts.isdigit() or not 1 <= int(shifts) <= 7:
         await callback.answer()
         return
+    est = estimate_income(data["city"], delivery)
+    if not est:
+        await callback.answer()
+        return
+    step("income_shifts", shifts=shifts)
+    await safe_edit(
+        callback.message,
+        income_text(data["city"], data["citizenship"], delivery, est, int(shifts)),
+        parse_mode="HTML",
+        reply_markup=screens.INCOME_RESULT_KEYBOARD
+    )
+    await callback.answer()
 
-    # Если нажали кнопки после расчёта
-    if callback.data == "income_bonus":
-        print("[STEP] Открыл бонусы для курьеров")
-        await safe_edit(
-    callback.message,
-            "🎁 <b>Бонусы для курьеров</b>\n\n"
-            "• Яндекс Байк за 1 ₽\n"
-            "• Комбо-обед за 95 ₽\n"
-            "• Скидка 20% в Яндекс Лавке\n"
-            "• Яндекс Плюс в подарок\n"
-            "• 100% чаевых ваши\n"
-            "• Промокод на Еду 300 ₽\n"
-            "• Скидка 10% в Ленте\n"
-            "• Бери Заряд бесплатно\n"
-            "• Юридическая поддержка",
-            parse_mode="HTML",
-            reply_markup=income_keyboard()
-        )
-    elif callback.data == "income_faq":
-        print("[STEP] Открыл FAQ")
-        await safe_edit(
-    callback.message,
-            "❓ <b>Частые вопросы</b>\n\n"
-            "• 🏫 <b>Нет опыта?</b>\n"
-            "Не переживайте, обучение предоставляется. Освоиться быстро!\n\n"
-            "• ⏰ <b>Какой график?</b>\n"
-            "Свободный режим: сами выбираете удобные слоты. Сами выбираете в какой день работать. Слот - это смена на несколько часов. Можно отработать один слот или несколько сразу.\n\n"
-            "• 💪 <b>Физически тяжело?</b>\n"
-            "Лёгкие доставки, выбираете заказы по силам.\n\n"
-            "• 📍 <b>Сложно ориентироваться?</b>\n"
-            "Есть удобное навигационное приложение.\n\n"
-            "• 🚶‍♂️ <b>Нет транспорта?</b>\n"
-            "Можно пешком, на вело или общественном транспорте.\n\n"
-            "• 🛡️ <b>Безопасно?</b>\n"
-            "Страхование и поддержка на маршруте гарантируют безопасность.\n\n",
-            parse_mode="HTML",
-            reply_markup=income_keyboard()
-        )
-    elif callback.data == "income_recalc":
-        print("[STEP] Нажал 'Рассчитать ещё раз'")
-        await state.update_data(
-            delivery=None,
-            day_income=None,
-            month_avg=None,
-            month_max=None
-        )
-        await safe_edit(
-    callback.message,
-            "Какой формат доставки вам подходит?",
-            reply_markup=delivery_keyboard()
-        )
-        await state.set_state(Form.waiting_for_delivery)
 
+# Кнопки после расчёта
+@callback_router.route("income_bonus", Form.waiting_for_delivery)
+@callback_router.route("income_faq", Form.waiting_for_delivery)
+async def income_info(callback: types.CallbackQuery, state: FSMContext):
+    action, _ = decode(callback.data)
+    step(action)
+    await show(callback.message, screens.SCREENS_BY_CALLBACK[action])
     await callback.answer()
 
 
+@callback_router.route("income_recalc", Form.waiting_for_delivery)
+async def income_recalc(callback: types.CallbackQuery, state: FSMContext):
+    step("income_recalc")
+    await state.update_data(
+        delivery=None,
+        delivery_code=None,
+        day_income=None,
+        month_avg=None,
+        month_max=None
+    )
+    await show(callback.message, screens.DELIVERY_RECALC)
+    await callback.answer()
+
+
+# ===============================
+# АДМИН
+# ===============================
+
+@dp.message(Command("refresh_income"))
+async def refresh_income(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    request_income_refresh()
+    await message.answer("🔄 Обновление таблицы доходов запущено")
+
+
 # ===============================
 # WEBHOOK
 # ===============================
 
+async def warm_up():
+    try:
+        await get_spreadsheet_id()
+        startup_report.mark("google warmed up")
+    except Exception:
+        logger.exception("Failed to warm up leads sheet")
+    startup_report.report()
+
 async def lifespan(app: FastAPI):
-    await bot.set_webhook(f"{WEBHOOK_URL}/{BOT_TOKEN}")
+    start_lead_worker()
+    if update_queue is not None:
+        update_queue.start()
+    # При нескольких воркерах вебхук ставит и снимает только лидер
+    owns_webhook = try_become_leader()
+    if owns_webhook:
+        await bot.set_webhook(f"{WEBHOOK_URL}/{BOT_TOKEN}")
+        startup_report.mark("webhook registered")
+    # Поднимаем кэш доходов с диска до первого пользователя, сверка с таблицей — в фоне
+    init_income_service()
+    # Прогрев Google: токен и ID таблицы лидов, пока нет пользователей
+    asyncio.create_task(warm_up())
     yield
-    await bot.delete_webhook()
+    if owns_webhook:
+        await bot.delete_webhook()
+    if update_queue is not None:
+        await update_queue.stop()
+    # 🔒 дописываем оставшиеся лиды в таблицу перед остановкой
+    await stop_lead_worker()
+    await edits.close()
+    await stop_income_service()
+    await close_sheets_clients()
+    analytics.close()
+
+async def process_update(update: Update):
+    await dp.feed_update(bot, update)
+
+# В режиме queue вебхук отвечает Telegram сразу, а апдейты обрабатывает пул воркеров
+update_queue = UpdateQueue(process_update) if WEBHOOK_MODE == "queue" else None
 
 app = FastAPI(lifespan=lifespan)
 
+metrics.gauge("bot_lead_queue_depth", "Leads waiting to be written to Sheets", get_queue_depth)
+metrics.gauge("bot_update_queue_depth", "Updates waiting for a worker",
+              lambda: update_queue.depth() if update_queue is not None else 0)
+metrics.gauge("bot_update_queue_dropped", "Updates dropped because the update queue was full",
+              lambda: update_queue.dropped if update_queue is not None else 0)
+metrics.gauge("bot_update_queue_spilled", "Updates spilled to disk because the update queue was full",
+              lambda: update_queue.spilled if update_queue is not None else 0)
+metrics.gauge("bot_duplicates_skipped", "Duplicate updates and taps dropped before handlers",
+              lambda: dedup.skipped)
+metrics.gauge("bot_throttle_buckets", "Per-user rate limit buckets kept in memory",
+              lambda: len(throttle.buckets))
+metrics.gauge("bot_income_snapshot_version", "Version of the income snapshot in memory",
+              lambda: get_income_snapshot().version)
+metrics.gauge("bot_income_snapshot_age_seconds", "Seconds since the income data was last confirmed",
+              lambda: get_income_snapshot().age or 0)
+metrics.gauge("bot_sheets_circuit_open", "1 while calls to Google Sheets are suspended",
+              lambda: int(sheets_breaker.state != "closed"))
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render())
+
 @app.post(f"/{BOT_TOKEN}")
 async def telegram_webhook(req: Request):
     update = Update.model_validate(await req.json())
-    await dp.feed_update(bot, update)
+    if update_queue is None:
+        await process_update(update)
+    elif not update_queue.submit(update):
+        return JSONResponse({"ok": False}, status_code=429)
     return {"ok": True}
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=80)
+    if is_multi_worker():
+        # Каждый воркер импортирует bot.py заново — uvicorn нужна строка импорта
+        uvicorn.run("bot:app", host="0.0.0.0", port=80, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=80)
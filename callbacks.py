@@ -0,0 +1,97 @@
+import zlib
+from aiogram.fsm.state import State
+
+
+# ===============================
+# КОДЕК CALLBACK_DATA
+# ===============================
+# callback_data = "<код>[:<аргумент>...]". Коды — 1–2 символа, аргументы — короткие
+# значения (номер страницы, индекс города), поэтому всё укладывается в 64 байта Telegram
+
+MAX_CALLBACK_BYTES = 64
+
+# действие -> (код, число аргументов)
+_ACTIONS = {
+    "info_conditions": ("ic", 0),
+    "info_requirements": ("iq", 0),
+    "calc_income": ("ci", 0),
+    "back_to_start": ("bs", 0),
+    "age_yes": ("ay", 0),
+    "age_no": ("an", 0),
+    "back_to_age": ("ba", 0),
+    "back_to_start_after_lead": ("bl", 0),
+    "citizenship": ("c", 1),      # код гражданства: ru, by, ...
+    "cities_page": ("p", 1),      # номер страницы
+    "city": ("t", 2),             # метка списка городов, индекс города в нём
+    "no_city": ("nc", 0),
+    "delivery": ("d", 1),         # foot | bike | car
+    "send_lead": ("sl", 0),
+    "income_bonus": ("ib", 0),
+    "income_faq": ("if", 0),
+    "income_recalc": ("ir", 0),
+    "shifts": ("sh", 1),          # смен в неделю
+}
+_BY_CODE = {code: (action, arity) for action, (code, arity) in _ACTIONS.items()}
+
+
+def encode(action: str, *args) -> str:
+    code, arity = _ACTIONS[action]
+    if len(args) != arity:
+        raise ValueError(f"{action} takes {arity} arguments, got {len(args)}")
+    data = ":".join((code, *map(str, args)))
+    if len(data.encode("utf-8")) > MAX_CALLBACK_BYTES:
+        raise ValueError(f"callback_data too long: {data!r}")
+    return data
+
+
+def decode(data: str | None) -> tuple[str | None, tuple]:
+    """(действие, аргументы); для чужих и битых данных — (None, ())."""
+    if not data:
+        return None, ()
+    code, *args = data.split(":")
+    entry = _BY_CODE.get(code)
+    if entry is None or len(args) != entry[1]:
+        return None, ()
+    return entry[0], tuple(args)
+
+
+def list_tag(items) -> str:
+    # Короткая метка содержимого списка: индекс из старой клавиатуры не попадёт в новый список
+    return format(zlib.crc32("\n".join(items).encode("utf-8")), "x")
+
+
+# ===============================
+# МАРШРУТИЗАЦИЯ
+# ===============================
+
+ANY_STATE = "*"
+
+
+class CallbackRouter:
+    """
+    Таблица (действие, состояние FSM) -> хендлер.
+
+    Вместо перебора фильтров aiogram один хендлер декодирует callback_data и
+    находит обработчик одним обращением к словарю: сначала для текущего
+    состояния, затем для любого.
+    """
+
+    def __init__(self):
+        self._routes: dict[tuple[str, str | None], object] = {}
+
+    def route(self, action: str, state: State | str | None = ANY_STATE):
+        if action not in _ACTIONS:
+            raise KeyError(action)
+        key = (action, state.state if isinstance(state, State) else state)
+
+        def decorator(handler):
+            if key in self._routes:
+                raise ValueError(f"duplicate callback route {key}")
+            self._routes[key] = handler
+            return handler
+        return decorator
+
+    def resolve(self, action: str | None, raw_state: str | None):
+        if action is None:
+            return None
+        return self._routes.get((action, raw_state)) or self._routes.get((action, ANY_STATE))
@@ -0,0 +1,187 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from metrics import counter, timed
+from workers import WORKERS, is_multi_worker
+logger = logging.getLogger(__name__)
+
+
+# === НАСТРОЙКИ ===
+# Лимиты Telegram: ~1 сообщение в секунду на чат (с небольшим всплеском) и ~30 в секунду на бота
+EDIT_PER_CHAT_RATE = float(os.environ.get("EDIT_PER_CHAT_RATE", "1"))
+EDIT_PER_CHAT_BURST = float(os.environ.get("EDIT_PER_CHAT_BURST", "3"))
+EDIT_GLOBAL_RATE = float(os.environ.get("EDIT_GLOBAL_RATE", "30"))
+EDIT_GLOBAL_BURST = float(os.environ.get("EDIT_GLOBAL_BURST", "30"))
+# Сколько сообщений помнить (последний отрисованный экран и бакеты чатов)
+EDIT_CACHE_SIZE = int(os.environ.get("EDIT_CACHE_SIZE", "50000"))
+# Сколько сериализованных клавиатур помнить для сравнения экранов
+MARKUP_CACHE_SIZE = int(os.environ.get("MARKUP_CACHE_SIZE", "2048"))
+
+IGNORED_ERRORS = ("message is not modified", "message can't be edited")
+
+EDITS = counter("bot_edits_total", "Outgoing message edits by result")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        # Забирает токен и возвращает, сколько нужно подождать до отправки
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class _Slot:
+    __slots__ = ("pending",)
+
+    def __init__(self):
+        # (fingerprint, send) — последняя ещё не отправленная правка
+        self.pending = None
+
+
+class EditDispatcher:
+    """
+    Слой исходящих редактирований сообщений.
+
+    * пропускает правки, которые не меняют уже отрисованный экран (в одном воркере);
+    * правки отправляет фоновая задача на сообщение — хендлер не ждёт ни сети,
+      ни лимитов, а очередь воркера не стоит из-за одного чата;
+    * пока задача ждёт лимит или отправляет правку, новые правки того же
+      сообщения схлопываются до последней;
+    * соблюдает лимиты Telegram токен-бакетами (на чат и на бота) вместо ловли 429.
+    """
+
+    def __init__(self):
+        self._rendered: OrderedDict = OrderedDict()   # (chat_id, message_id) -> fingerprint
+        self._buckets: OrderedDict = OrderedDict()    # chat_id -> TokenBucket
+        # Лимит на бота общий, а бакет живёт в каждом воркере — делим поровну
+        self._global = TokenBucket(EDIT_GLOBAL_RATE / WORKERS, max(1.0, EDIT_GLOBAL_BURST / WORKERS))
+        self._slots: dict[tuple, _Slot] = {}
+        self._markups: OrderedDict = OrderedDict()    # id(markup) -> (markup, JSON)
+        self._tasks: set[asyncio.Task] = set()
+
+    def fingerprint(self, text, reply_markup, parse_mode=None) -> tuple:
+        return text, self._markup_json(reply_markup), parse_mode
+
+    def _markup_json(self, reply_markup) -> str | None:
+        # Клавиатуры экранов и списков городов собраны заранее и не меняются —
+        # сериализуем каждую один раз. Ссылка на объект в кэше не даёт его id
+        # достаться новой клавиатуре, пока запись жива
+        if reply_markup is None:
+            return None
+        entry = self._markups.get(id(reply_markup))
+        if entry is not None and entry[0] is reply_markup:
+            self._markups.move_to_end(id(reply_markup))
+            return entry[1]
+        markup = reply_markup.model_dump_json(exclude_none=True)
+        self._markups[id(reply_markup)] = (reply_markup, markup)
+        if len(self._markups) > MARKUP_CACHE_SIZE:
+            self._markups.popitem(last=False)
+        return markup
+
+    async def edit_text(self, message, text, **kwargs):
+        fp = self.fingerprint(text, kwargs.get("reply_markup"), kwargs.get("parse_mode"))
+        self._submit(message, fp, lambda: message.edit_text(text, **kwargs))
+
+    async def edit_markup(self, message, reply_markup):
+        # Текст не меняется — берём его из последнего отрисованного состояния
+        key = (message.chat.id, message.message_id)
+        prev = self._rendered.get(key)
+        text = prev[0] if prev else message.text
+        parse_mode = prev[2] if prev else None
+        fp = self.fingerprint(text, reply_markup, parse_mode)
+        self._submit(message, fp, lambda: message.edit_reply_markup(reply_markup=reply_markup))
+
+    def _submit(self, message, fp, send):
+        key = (message.chat.id, message.message_id)
+        slot = self._slots.get(key)
+        if slot is not None:
+            # Сообщением уже занимается отправитель — подменяем его отложенную правку
+            if slot.pending is not None:
+                EDITS.inc(result="coalesced")
+            slot.pending = (fp, send)
+            return
+
+        slot = self._slots[key] = _Slot()
+        slot.pending = (fp, send)
+        task = asyncio.create_task(self._sender(key, slot), name=f"edit-{key[0]}-{key[1]}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _sender(self, key, slot):
+        try:
+            while slot.pending is not None:
+                if self._is_rendered(key, slot.pending[0]):
+                    slot.pending = None
+                    EDITS.inc(result="skipped")
+                    continue
+                await self._throttle(key[0])
+                # За время ожидания могла прийти правка новее — отправляем самую свежую
+                (fp, send), slot.pending = slot.pending, None
+                if self._is_rendered(key, fp):
+                    EDITS.inc(result="skipped")
+                    continue
+                try:
+                    await self._send(key, fp, send)
+                except Exception:
+                    EDITS.inc(result="failed")
+                    logger.exception("Failed to edit message %s in chat %s", key[1], key[0])
+        finally:
+            del self._slots[key]
+
+    def _is_rendered(self, key, fp) -> bool:
+        # Апдейты одного чата попадают в разные воркеры, и каждый видит только свои
+        # правки — «уже отрисовано» в одном процессе не значит, что так на экране
+        if is_multi_worker():
+            return False
+        return self._rendered.get(key) == fp
+
+    async def _send(self, key, fp, send):
+        try:
+            with timed("telegram_edit"):
+                await send()
+        except TelegramRetryAfter as e:
+            # Лимит всё же сработал — ждём, сколько просит Telegram, и повторяем один раз
+            EDITS.inc(result="retry_after")
+            await asyncio.sleep(e.retry_after)
+            with timed("telegram_edit"):
+                await send()
+        except TelegramBadRequest as e:
+            if not any(x in str(e) for x in IGNORED_ERRORS):
+                raise
+        self._remember(key, fp)
+        EDITS.inc(result="sent")
+
+    async def _throttle(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(EDIT_PER_CHAT_RATE, EDIT_PER_CHAT_BURST)
+            if len(self._buckets) > EDIT_CACHE_SIZE:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(chat_id)
+        wait = max(bucket.reserve(), self._global.reserve())
+        if wait > 0:
+            EDITS.inc(result="throttled")
+            await asyncio.sleep(wait)
+
+    async def close(self, timeout: float = 10):
+        # Дописываем отложенные правки перед остановкой
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+
+    def _remember(self, key, fp):
+        self._rendered[key] = fp
+        self._rendered.move_to_end(key)
+        if len(self._rendered) > EDIT_CACHE_SIZE:
+            self._rendered.popitem(last=False)
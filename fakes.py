@@ -0,0 +1,297 @@
+"""
+Локальные заглушки Google Sheets и Telegram Bot API для стресс-тестов без сети.
+
+Включаются конфигурацией:
+    GOOGLE_BACKEND=fake      — get_sheets_client() отдаёт FakeSheetsClient
+    TELEGRAM_BACKEND=fake    — Bot в bot.py работает через FakeTelegramSession
+
+Поведение настраивается переменными окружения:
+    FAKE_LATENCY_MS, FAKE_JITTER_MS    — задержка каждого вызова
+    FAKE_ERROR_RATE                    — доля вызовов, которые падают с 429
+    FAKE_SHEETS_DB                     — файл SQLite для таблиц (":memory:" по умолчанию)
+    FAKE_INCOME_CITIES                 — сколько городов сгенерировать в таблице доходов
+"""
+import os
+import json
+import hashlib
+import random
+import asyncio
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+FAKE_LATENCY_MS = float(os.environ.get("FAKE_LATENCY_MS", "0"))
+FAKE_JITTER_MS = float(os.environ.get("FAKE_JITTER_MS", "0"))
+FAKE_ERROR_RATE = float(os.environ.get("FAKE_ERROR_RATE", "0"))
+FAKE_SHEETS_DB = os.environ.get("FAKE_SHEETS_DB", ":memory:")
+FAKE_INCOME_CITIES = int(os.environ.get("FAKE_INCOME_CITIES", "100"))
+
+INCOME_HEADERS = ["city", "delivery", "day", "month_avg", "month_max", "eaes", "not_rf"]
+DELIVERIES = ("foot", "bike", "car")
+TOP_CITY_NAMES = (
+    "Москва", "Санкт-Петербург", "Екатеринбург", "Новосибирск",
+    "Казань", "Нижний Новгород",
+)
+
+
+class FaultInjector:
+    """Задержка с джиттером и случайные ошибки квоты — одинаково для Google и Telegram."""
+
+    def __init__(self, latency_ms=FAKE_LATENCY_MS, jitter_ms=FAKE_JITTER_MS,
+                 error_rate=FAKE_ERROR_RATE, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+
+    def delay(self) -> float:
+        jitter = self._random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0
+        return max(0.0, self.latency_ms + jitter) / 1000
+
+    def should_fail(self) -> bool:
+        self.calls += 1
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+
+def synthetic_income_values(cities: int, seed: int = 42) -> list[list[str]]:
+    names = list(TOP_CITY_NAMES) + [
+        f"Город {i:04d}" for i in range(max(0, cities - len(TOP_CITY_NAMES)))
+    ]
+    rnd = random.Random(seed)
+    rows = [list(INCOME_HEADERS)]
+    for name in names[:cities]:
+        for delivery in DELIVERIES:
+            day = rnd.randint(2000, 9000)
+            rows.append([
+                name, delivery, str(day), str(day * 22), str(day * 30),
+                "TRUE" if rnd.random() < 0.7 else "FALSE",
+                "TRUE" if rnd.random() < 0.4 else "FALSE",
+            ])
+    return rows
+
+
+# ===============================
+# GOOGLE SHEETS
+# ===============================
+
+class FakeWorksheet:
+    """Лист в SQLite: строки хранятся как JSON-массивы в порядке вставки."""
+
+    def __init__(self, spreadsheet, index: int = 0):
+        self.spreadsheet = spreadsheet
+        self.id = index
+        self._table = f"ws_{_name_id(spreadsheet.name)}_{index}"
+        with spreadsheet.client.db_lock:
+            spreadsheet.client.db.execute(
+                f"CREATE TABLE IF NOT EXISTS {self._table} (row TEXT NOT NULL)"
+            )
+
+    def rows(self) -> list[list[str]]:
+        client = self.spreadsheet.client
+        with client.db_lock:
+            return [[str(v) for v in json.loads(r[0])] for r in client.db.execute(
+                f"SELECT row FROM {self._table} ORDER BY rowid"
+            )]
+
+    def insert(self, rows):
+        client = self.spreadsheet.client
+        with client.db_lock:
+            client.db.executemany(
+                f"INSERT INTO {self._table} (row) VALUES (?)",
+                [(json.dumps(row, ensure_ascii=False),) for row in rows],
+            )
+        self.spreadsheet.touch()
+
+    @property
+    def row_count(self) -> int:
+        client = self.spreadsheet.client
+        with client.db_lock:
+            return client.db.execute(f"SELECT COUNT(*) FROM {self._table}").fetchone()[0]
+
+
+class FakeSpreadsheet:
+    def __init__(self, client, name: str):
+        self.client = client
+        self.name = name
+        self.id = f"fake-{_name_id(name)}"
+        self.modified_time = _now_rfc3339()
+        self._worksheets = {}
+
+    def touch(self):
+        self.modified_time = _now_rfc3339()
+
+    def get_worksheet(self, index: int):
+        worksheet = self._worksheets.get(index)
+        if worksheet is None:
+            worksheet = self._worksheets[index] = FakeWorksheet(self, index)
+        return worksheet
+
+    @property
+    def sheet1(self):
+        return self.get_worksheet(0)
+
+
+class FakeGoogleClient:
+    """Хранилище фейковых таблиц: по названию и по ID, с общими задержками и ошибками."""
+
+    def __init__(self, db_path: str = FAKE_SHEETS_DB, faults: FaultInjector | None = None,
+                 income_cities: int = FAKE_INCOME_CITIES):
+        self.faults = faults or FaultInjector()
+        self.db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self.db_lock = threading.Lock()
+        self._income_cities = income_cities
+        self._spreadsheets = {}
+
+    def open(self, name: str) -> FakeSpreadsheet:
+        spreadsheet = self._spreadsheets.get(name)
+        if spreadsheet is None:
+            spreadsheet = self._spreadsheets[name] = FakeSpreadsheet(self, name)
+            self._seed(spreadsheet)
+        return spreadsheet
+
+    def open_by_key(self, spreadsheet_id: str) -> FakeSpreadsheet:
+        for spreadsheet in self._spreadsheets.values():
+            if spreadsheet.id == spreadsheet_id:
+                return spreadsheet
+        raise KeyError(spreadsheet_id)
+
+    def _seed(self, spreadsheet: FakeSpreadsheet):
+        from table_income import INCOME_SPREADSHEET
+
+        sheet = spreadsheet.sheet1
+        if spreadsheet.name == INCOME_SPREADSHEET and sheet.row_count == 0:
+            with self.db_lock:
+                self.db.executemany(
+                    f"INSERT INTO {sheet._table} (row) VALUES (?)",
+                    [(json.dumps(row, ensure_ascii=False),)
+                     for row in synthetic_income_values(self._income_cities)],
+                )
+
+
+def _column_slice(range_: str) -> slice:
+    # "A:Z", "K:K" — диапазоны столбцов в нотации A1 без номеров строк
+    def index(letters: str) -> int:
+        n = 0
+        for ch in letters.upper():
+            n = n * 26 + ord(ch) - ord("A") + 1
+        return n
+
+    first, _, last = range_.rpartition("!")[2].partition(":")
+    return slice(index(first) - 1, index(last or first))
+
+
+class FakeSheetsClient:
+    """Повторяет интерфейс google_client.AsyncSheetsClient поверх FakeGoogleClient."""
+
+    def __init__(self, google: FakeGoogleClient):
+        self.google = google
+
+    async def _call(self):
+        from google_client import SheetsAPIError
+
+        faults = self.google.faults
+        delay = faults.delay()
+        if delay:
+            await asyncio.sleep(delay)
+        if faults.should_fail():
+            raise SheetsAPIError(429, "Quota exceeded (fake)")
+
+    async def spreadsheet_id(self, name: str, spreadsheet_id: str | None = None) -> str:
+        return spreadsheet_id or self.google.open(name).id
+
+    async def batch_get(self, spreadsheet_id: str, ranges: list[str]) -> list[list[list[str]]]:
+        await self._call()
+        rows = self.google.open_by_key(spreadsheet_id).sheet1.rows()
+        result = []
+        for r in ranges:
+            columns = _column_slice(r)
+            result.append([row[columns] for row in rows if row[columns]])
+        return result
+
+    async def append(self, spreadsheet_id: str, range_: str, rows: list[list]):
+        await self._call()
+        self.google.open_by_key(spreadsheet_id).sheet1.insert(rows)
+
+    async def modified_time(self, spreadsheet_id: str) -> str:
+        delay = self.google.faults.delay()
+        if delay:
+            await asyncio.sleep(delay)
+        return self.google.open_by_key(spreadsheet_id).modified_time
+
+
+def _name_id(name: str) -> str:
+    # Стабильный между процессами идентификатор (в отличие от hash())
+    return hashlib.sha1(name.encode("utf-8")).hexdigest()[:12]
+
+
+def _now_rfc3339() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+_google_client: FakeGoogleClient | None = None
+_google_lock = threading.Lock()
+
+
+def get_fake_google_client() -> FakeGoogleClient:
+    # Один фейковый «Google» на процесс — как и настоящий клиент
+    global _google_client
+    with _google_lock:
+        if _google_client is None:
+            _google_client = FakeGoogleClient()
+    return _google_client
+
+
+def get_fake_sheets_client() -> FakeSheetsClient:
+    return FakeSheetsClient(get_fake_google_client())
+
+
+# ===============================
+# TELEGRAM BOT API
+# ===============================
+
+def create_fake_telegram_session(faults: FaultInjector | None = None):
+    from aiogram.client.session.base import BaseSession
+    from aiogram.exceptions import TelegramRetryAfter
+    from aiogram.methods import SendMessage
+    from aiogram.types import Chat, Message
+
+    class FakeTelegramSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            self.faults = faults or FaultInjector()
+            self.calls: dict[str, int] = {}
+            self._message_ids = iter(range(1, 10**12))
+
+        async def make_request(self, bot, method, timeout=None):
+            name = type(method).__name__
+            self.calls[name] = self.calls.get(name, 0) + 1
+            delay = self.faults.delay()
+            if delay:
+                await asyncio.sleep(delay)
+            if self.faults.should_fail():
+                raise TelegramRetryAfter(
+                    method=method, message="Too Many Requests (fake)", retry_after=1
+                )
+            if isinstance(method, SendMessage):
+                return Message(
+                    message_id=next(self._message_ids),
+                    date=datetime.now(),
+                    chat=Chat(id=method.chat_id, type="private"),
+                    text=method.text,
+                )
+            return True
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            # У фейкового Bot API нет файлов — скачивание отдаёт пустое содержимое
+            for chunk in ():
+                yield chunk
+
+        async def close(self):
+            pass
+
+    return FakeTelegramSession()
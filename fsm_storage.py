@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from metrics import timed
+from workers import is_multi_worker
+logger = logging.getLogger(__name__)
+
+
+# === НАСТРОЙКИ ===
+FSM_STORAGE = os.environ.get("FSM_STORAGE", "sqlite")  # sqlite | memory
+FSM_DB_PATH = os.environ.get("FSM_DB_PATH", "fsm.sqlite3")
+FSM_CACHE_SIZE = int(os.environ.get("FSM_CACHE_SIZE", "10000"))
+# Брошенные воронки удаляются через сутки
+FSM_TTL = int(os.environ.get("FSM_TTL", str(24 * 3600)))
+# Как часто (в записях) чистить просроченные строки в базе
+_CLEANUP_EVERY = 1000
+
+
+def _key_to_str(key: StorageKey) -> str:
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or 0}:{key.destiny}"
+
+
+def _state_to_str(state: StateType) -> Optional[str]:
+    return state.state if isinstance(state, State) else state
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище на локальном SQLite (WAL) с LRU-кэшем горячих записей.
+
+    В памяти держим не больше FSM_CACHE_SIZE пользователей, всё остальное
+    лежит на диске и переживает перезапуск процесса.
+    """
+
+    def __init__(self, path: str = FSM_DB_PATH, cache_size: int = FSM_CACHE_SIZE, ttl: int = FSM_TTL):
+        self._ttl = ttl
+        self._cache_size = cache_size
+        # key -> (state, data, expires_at)
+        self._cache: OrderedDict[str, tuple] = OrderedDict()
+        self._writes = 0
+
+        # Несколько процессов пишут в один файл: кэш одного воркера не видит чужих
+        # записей, поэтому в этом режиме каждое чтение идёт в базу
+        if is_multi_worker():
+            self._cache_size = 0
+
+        # Запросы к локальному файлу занимают микросекунды, поэтому в одном процессе выполняем
+        # их прямо в event loop. С несколькими воркерами запись может ждать чужую блокировку
+        # базы до timeout — тогда обращения идут в поток, по одному на соединение
+        self._threaded = is_multi_worker()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS fsm ("
+            " key TEXT PRIMARY KEY,"
+            " state TEXT,"
+            " data TEXT,"
+            " expires_at REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS fsm_expires ON fsm (expires_at)")
+
+    # --- кэш ---
+    def _load(self, key: str) -> tuple:
+        now = time.time()
+        entry = self._cache.get(key)
+        if entry is not None and entry[2] > now:
+            self._cache.move_to_end(key)
+            return entry
+
+        with timed("fsm_db_read"):
+            row = self._conn.execute(
+                "SELECT state, data, expires_at FROM fsm WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[2] <= now:
+            entry = (None, {}, now + self._ttl)
+        else:
+            entry = (row[0], json.loads(row[1]) if row[1] else {}, row[2])
+        self._remember(key, entry)
+        return entry
+
+    def _remember(self, key: str, entry: tuple):
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    def _store(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        expires_at = time.time() + self._ttl
+        with timed("fsm_db_write"):
+            self._write(key, state, data, expires_at)
+        self._remember(key, (state, data, expires_at))
+
+        self._writes += 1
+        if self._writes % _CLEANUP_EVERY == 0:
+            self._cleanup()
+
+    def _write(self, key: str, state: Optional[str], data: Dict[str, Any], expires_at: float):
+        if state is None and not data:
+            self._conn.execute("DELETE FROM fsm WHERE key = ?", (key,))
+        else:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO fsm (key, state, data, expires_at) VALUES (?, ?, ?, ?)",
+                (
+                    key,
+                    state,
+                    json.dumps(data, ensure_ascii=False, separators=(",", ":")) if data else None,
+                    expires_at,
+                ),
+            )
+
+    def _cleanup(self):
+        deleted = self._conn.execute(
+            "DELETE FROM fsm WHERE expires_at <= ?", (time.time(),)
+        ).rowcount
+        if deleted:
+            logger.info("FSM storage: removed %d expired entries", deleted)
+
+    def _run_locked(self, fn, *args):
+        with self._lock:
+            return fn(*args)
+
+    async def _run(self, fn, *args):
+        if not self._threaded:
+            return fn(*args)
+        return await asyncio.to_thread(self._run_locked, fn, *args)
+
+    def _set_state(self, skey: str, state: Optional[str]):
+        _, data, _ = self._load(skey)
+        self._store(skey, state, data)
+
+    def _set_data(self, skey: str, data: Dict[str, Any]):
+        state, _, _ = self._load(skey)
+        self._store(skey, state, data)
+
+    # --- BaseStorage ---
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._run(self._set_state, _key_to_str(key), _state_to_str(state))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._run(self._load, _key_to_str(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._run(self._set_data, _key_to_str(key), data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._run(self._load, _key_to_str(key)))[1].copy()
+
+    async def close(self) -> None:
+        await self._run(self._conn.close)
+
+
+def create_storage() -> BaseStorage:
+    if FSM_STORAGE == "memory":
+        if not is_multi_worker():
+            return MemoryStorage()
+        # Память процесса не делится между воркерами — состояние воронки потерялось бы
+        logger.warning("FSM_STORAGE=memory is not shared between workers, using SQLite")
+    logger.info("Using SQLite FSM storage at %s", FSM_DB_PATH)
+    return SQLiteStorage()
@@ -1,19 +1,239 @@
 import os
 import json
 import base64
-import gspread
-from google.oauth2.service_account import Credentials
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import TYPE_CHECKING
+from urllib.parse import quote
+# aiohttp приходит вместе с aiogram; google-auth тяжёлый — импортируем при первом обращении к Google
+if TYPE_CHECKING:
+    import aiohttp
+from metrics import timed
+logger = logging.getLogger(__name__)
 
-def get_google_client(scopes: list[str]) -> gspread.Client:
+
+# real | fake — локальная заглушка из fakes.py для тестов без сети
+GOOGLE_BACKEND = os.environ.get("GOOGLE_BACKEND", "real")
+
+# Обновляем токен заранее, чтобы запрос пользователя не ждал OAuth
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+# После стольких неудач подряд перестаём ходить в Sheets на SHEETS_BREAKER_COOLDOWN секунд
+SHEETS_BREAKER_THRESHOLD = int(os.environ.get("SHEETS_BREAKER_THRESHOLD", "5"))
+SHEETS_BREAKER_COOLDOWN = float(os.environ.get("SHEETS_BREAKER_COOLDOWN", "120"))
+
+SHEETS_API_URL = "https://sheets.googleapis.com/v4/spreadsheets"
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files"
+# Общий пул HTTP-соединений к Google на процесс
+SHEETS_POOL_SIZE = int(os.environ.get("SHEETS_POOL_SIZE", "20"))
+SHEETS_TIMEOUT = float(os.environ.get("SHEETS_TIMEOUT", "30"))
+
+_clients: dict[frozenset, "AsyncSheetsClient"] = {}
+_session: "aiohttp.ClientSession | None" = None
+_lock = threading.Lock()
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для внешнего API: после threshold неудач подряд размыкается
+    и cooldown секунд не пропускает запросы, затем пропускает один пробный.
+    Удачный пробный запрос замыкает цепь, неудачный — снова размыкает.
+    """
+
+    def __init__(self, name: str, threshold: int, cooldown: float):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self._opened_at: float | None = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        return "half_open" if self._trial else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self._opened_at < self.cooldown:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("%s circuit closed", self.name)
+            self.failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or (self._opened_at is None and self.failures >= self.threshold):
+                logger.warning("%s circuit opened after %d failures", self.name, self.failures)
+                self._opened_at = time.monotonic()
+            self._trial = False
+
+
+# Общий для доходов и лидов: квота и доступность у них одна
+sheets_breaker = CircuitBreaker("Google Sheets", SHEETS_BREAKER_THRESHOLD, SHEETS_BREAKER_COOLDOWN)
+
+
+@lru_cache(maxsize=1)
+def _credentials_info() -> dict:
+    # Ключ сервисного аккаунта декодируем один раз на процесс
     decoded_json = base64.b64decode(
         os.environ["GOOGLE_CRED_JSON_IN_BASE_64"]
     ).decode("utf-8")
+    return json.loads(decoded_json)
+
+
+class SheetsAPIError(Exception):
+    """Google ответил ошибкой; status — HTTP-код ответа."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+
+class SheetsNetworkError(Exception):
+    """Ответа нет (таймаут, обрыв соединения) — запрос мог как пройти, так и нет."""
+
+
+def _get_session() -> "aiohttp.ClientSession":
+    global _session
+    if _session is None or _session.closed:
+        import aiohttp
+
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=SHEETS_POOL_SIZE, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=SHEETS_TIMEOUT),
+        )
+    return _session
+
+
+class AsyncSheetsClient:
+    """
+    Sheets API v4 и Drive v3 поверх общего пула aiohttp-соединений.
+
+    Все вызовы — корутины и выполняются прямо в event loop; в отдельный поток
+    уходит только обновление OAuth-токена (раз в час, google-auth синхронный).
+    """
+
+    def __init__(self, scopes: list[str]):
+        self.scopes = list(scopes)
+        self._creds = None
+        self._token_lock = asyncio.Lock()
+        self._ids: dict[str, str] = {}
+
+    async def _token(self) -> str:
+        async with self._token_lock:
+            if self._creds is None:
+                from google.oauth2.service_account import Credentials
+
+                self._creds = Credentials.from_service_account_info(_credentials_info(), scopes=self.scopes)
+            creds = self._creds
+            # Обновляем токен заранее, чтобы запрос пользователя не ждал OAuth
+            if not (creds.valid and creds.expiry and creds.expiry - datetime.utcnow() > TOKEN_REFRESH_MARGIN):
+                from google.auth.transport.requests import Request
+
+                with timed("google_token_refresh"):
+                    await asyncio.to_thread(creds.refresh, Request())
+                logger.debug("Google token refreshed, expires at %s", creds.expiry)
+            return creds.token
+
+    async def _request(self, method: str, url: str, *, params=None, payload=None) -> dict:
+        import aiohttp
+
+        headers = {"Authorization": f"Bearer {await self._token()}"}
+        try:
+            async with _get_session().request(method, url, params=params, json=payload, headers=headers) as resp:
+                body = await resp.text()
+                status = resp.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise SheetsNetworkError(f"{method} {url}: {e!r}") from e
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            data = {}
+        if status >= 400:
+            message = data.get("error", {}).get("message") if isinstance(data, dict) else None
+            raise SheetsAPIError(status, message or body[:200])
+        return data
+
+    async def spreadsheet_id(self, name: str, spreadsheet_id: str | None = None) -> str:
+        """ID таблицы: из конфигурации, а если его нет — один поиск по названию в Drive на процесс."""
+        if spreadsheet_id:
+            return spreadsheet_id
+        found = self._ids.get(name)
+        if found is None:
+            with timed("drive_find_spreadsheet"):
+                data = await self._request("GET", DRIVE_FILES_URL, params={
+                    "q": f"name = '{name}' and mimeType = 'application/vnd.google-apps.spreadsheet' and trashed = false",
+                    "fields": "files(id)",
+                    "supportsAllDrives": "true",
+                    "includeItemsFromAllDrives": "true",
+                })
+            files = data.get("files") or []
+            if not files:
+                raise SheetsAPIError(404, f"spreadsheet {name!r} not found")
+            found = self._ids[name] = files[0]["id"]
+        return found
+
+    async def batch_get(self, spreadsheet_id: str, ranges: list[str]) -> list[list[list]]:
+        """
+        Значения нескольких диапазонов одним запросом, в порядке ranges.
+
+        Значения без форматирования листа: числа приходят числами, флажки — bool,
+        и разделители разрядов или валюта в ячейке не ломают разбор.
+        """
+        params = [("ranges", r) for r in ranges] + [
+            ("majorDimension", "ROWS"), ("valueRenderOption", "UNFORMATTED_VALUE"),
+        ]
+        data = await self._request("GET", f"{SHEETS_API_URL}/{spreadsheet_id}/values:batchGet", params=params)
+        return [vr.get("values", []) for vr in data.get("valueRanges", [])]
+
+    async def append(self, spreadsheet_id: str, range_: str, rows: list[list]):
+        await self._request(
+            "POST",
+            f"{SHEETS_API_URL}/{spreadsheet_id}/values/{quote(range_, safe='')}:append",
+            params={"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"},
+            payload={"values": rows},
+        )
+
+    async def modified_time(self, spreadsheet_id: str) -> str:
+        data = await self._request("GET", f"{DRIVE_FILES_URL}/{spreadsheet_id}", params={
+            "fields": "modifiedTime", "supportsAllDrives": "true",
+        })
+        return data["modifiedTime"]
+
+
+def get_sheets_client(scopes: list[str]) -> AsyncSheetsClient:
+    if GOOGLE_BACKEND == "fake":
+        from fakes import get_fake_sheets_client
+        return get_fake_sheets_client()
 
-    key_dict = json.loads(decoded_json)
+    key = frozenset(scopes)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            # Один клиент (и один токен) на набор прав; пул соединений общий
+            client = _clients[key] = AsyncSheetsClient(scopes)
+    return client
 
-    creds = Credentials.from_service_account_info(
-        key_dict,
-        scopes=scopes
-    )
 
-    return gspread.authorize(creds)
\ No newline at end of file
+async def close_sheets_clients():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
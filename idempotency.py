@@ -0,0 +1,81 @@
+import os
+import time
+import logging
+from collections import OrderedDict
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+logger = logging.getLogger(__name__)
+
+
+# === НАСТРОЙКИ ===
+# Telegram повторяет вебхук в течение нескольких минут — держим id с запасом
+UPDATE_ID_TTL = float(os.environ.get("UPDATE_ID_TTL", "600"))
+# Окно, в котором повторное нажатие той же кнопки считается двойным тапом
+DOUBLE_TAP_WINDOW = float(os.environ.get("DOUBLE_TAP_WINDOW", "1.0"))
+IDEMPOTENCY_MAXSIZE = int(os.environ.get("IDEMPOTENCY_MAXSIZE", "100000"))
+
+
+class RecentIds:
+    """Скользящее окно недавно виденных ключей с ограничением по памяти."""
+
+    def __init__(self, ttl: float, maxsize: int = IDEMPOTENCY_MAXSIZE):
+        self._ttl = ttl
+        self._maxsize = maxsize
+        self._seen: OrderedDict = OrderedDict()  # key -> время, когда увидели
+
+    def seen(self, key) -> bool:
+        # True — ключ уже был в окне; иначе запоминаем его и возвращаем False
+        now = time.monotonic()
+        self._evict(now)
+        if key in self._seen:
+            return True
+        self._seen[key] = now
+        if len(self._seen) > self._maxsize:
+            self._seen.popitem(last=False)
+        return False
+
+    def discard(self, key):
+        self._seen.pop(key, None)
+
+    def _evict(self, now: float):
+        # Ключи упорядочены по времени добавления — чистим с головы
+        while self._seen:
+            key, ts = next(iter(self._seen.items()))
+            if now - ts < self._ttl:
+                break
+            self._seen.popitem(last=False)
+
+    def __len__(self):
+        return len(self._seen)
+
+
+class DedupMiddleware(BaseMiddleware):
+    """
+    Отсекает повторы до хендлеров: ретраи вебхука по update_id / id коллбэка
+    и двойные нажатия одной и той же кнопки в одном сообщении.
+    """
+
+    def __init__(self):
+        self.updates = RecentIds(UPDATE_ID_TTL)
+        self.callbacks = RecentIds(UPDATE_ID_TTL)
+        self.taps = RecentIds(DOUBLE_TAP_WINDOW)
+        self.skipped = 0
+
+    async def __call__(self, handler, event: Update, data: dict):
+        if self.updates.seen(event.update_id):
+            self.skipped += 1
+            return None
+
+        cq = event.callback_query
+        if cq is not None:
+            message_id = cq.message.message_id if cq.message else cq.inline_message_id
+            if self.callbacks.seen(cq.id) or self.taps.seen((cq.from_user.id, message_id, cq.data)):
+                self.skipped += 1
+                # Отвечаем на коллбэк, чтобы у пользователя не висели «часики»
+                try:
+                    await data["bot"].answer_callback_query(cq.id)
+                except Exception:
+                    logger.debug("Failed to answer duplicate callback %s", cq.id)
+                return None
+
+        return await handler(event, data)
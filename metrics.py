@@ -0,0 +1,209 @@
+import sys
+import time
+import queue
+import bisect
+import logging
+import threading
+import logging.handlers
+from contextlib import contextmanager
+from contextvars import ContextVar
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery
+import analytics
+from callbacks import decode
+logger = logging.getLogger(__name__)
+
+
+# ===============================
+# МЕТРИКИ (формат Prometheus text exposition)
+# ===============================
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.RLock()
+
+
+def _labels_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: tuple, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in key]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels_key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self._buckets = buckets
+        # key -> [счётчики по бакетам..., +Inf], сумма
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = _labels_key(labels)
+        idx = bisect.bisect_left(self._buckets, value)
+        with _lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self._buckets) + 1), 0.0]
+            entry[0][idx] += 1
+            entry[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self._buckets, counts):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(key, le)} {cumulative}")
+            cumulative += counts[-1]
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    # Значение снимается в момент запроса /metrics
+    def __init__(self, name: str, help: str, fn):
+        self.name = name
+        self.help = help
+        self._fn = fn
+
+    def render(self) -> list[str]:
+        try:
+            value = self._fn()
+        except Exception:
+            logger.exception("Failed to read gauge %s", self.name)
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+_registry: dict[str, object] = {}
+
+
+def counter(name: str, help: str) -> Counter:
+    return _registry.setdefault(name, Counter(name, help))
+
+
+def histogram(name: str, help: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+    return _registry.setdefault(name, Histogram(name, help, buckets))
+
+
+def gauge(name: str, help: str, fn) -> Gauge:
+    metric = Gauge(name, help, fn)
+    _registry[name] = metric
+    return metric
+
+
+def render() -> str:
+    lines = []
+    with _lock:
+        for metric in _registry.values():
+            lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# === ОБЩИЕ МЕТРИКИ ===
+HANDLER_LATENCY = histogram("bot_handler_seconds", "Handler latency by handler and callback prefix")
+OPERATION_LATENCY = histogram("bot_operation_seconds", "Latency of external calls and storage access")
+OPERATION_ERRORS = counter("bot_operation_errors_total", "Failed external calls and storage access")
+FUNNEL_STEPS = counter("bot_funnel_steps_total", "Funnel transitions by step")
+
+
+@contextmanager
+def timed(op: str):
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        OPERATION_ERRORS.inc(op=op)
+        raise
+    finally:
+        OPERATION_LATENCY.observe(time.perf_counter() - start, op=op)
+
+
+def callback_prefix(data: str | None) -> str:
+    # Действие из кодека: набор значений конечен, аргументы (страницы, индексы) в метку не попадают
+    if not data:
+        return "none"
+    action, _ = decode(data)
+    return action or "other"
+
+
+# Хендлер, до которого дошёл апдейт внутри общей точки входа (route_callback)
+current_handler: ContextVar[str | None] = ContextVar("current_handler", default=None)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Время работы хендлеров по имени хендлера и префиксу callback_data."""
+
+    async def __call__(self, handler, event, data: dict):
+        handler_obj = data.get("handler")
+        name = getattr(getattr(handler_obj, "callback", None), "__name__", "unknown")
+        prefix = callback_prefix(event.data) if isinstance(event, CallbackQuery) else "message"
+        # Пользователь апдейта — для событий воронки, которые шлёт step()
+        user = getattr(event, "from_user", None)
+        current_user.set(user.id if user else None)
+        current_handler.set(None)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            HANDLER_LATENCY.observe(
+                time.perf_counter() - start, handler=current_handler.get() or name, prefix=prefix
+            )
+
+
+# ===============================
+# ЛОГИРОВАНИЕ
+# ===============================
+
+funnel_logger = logging.getLogger("funnel")
+current_user: ContextVar[int | None] = ContextVar("current_user", default=None)
+
+
+def step(name: str, **fields):
+    # Замена print("[STEP] ..."): счётчик шага, структурированная строка лога и событие для отчётов
+    FUNNEL_STEPS.inc(step=name)
+    funnel_logger.info("step=%s %s", name, " ".join(f"{k}={v}" for k, v in fields.items()))
+    analytics.emit(name, current_user.get(), fields)
+
+
+def setup_logging(level=logging.INFO):
+    # Хендлеры пишут в очередь, а в stderr пишет отдельный поток — event loop не ждёт I/O
+    log_queue = queue.SimpleQueue()
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(logging.Formatter(
+        "ts=%(asctime)s level=%(levelname)s logger=%(name)s msg=%(message)s"
+    ))
+    listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    listener.start()
+
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+    return listener
@@ -0,0 +1,227 @@
+from types import MappingProxyType
+from typing import NamedTuple
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from callbacks import encode
+
+
+# ===============================
+# СТАТИЧЕСКИЕ ЭКРАНЫ
+# ===============================
+# Все неизменяемые тексты и клавиатуры собираются один раз при импорте,
+# хендлеры только берут готовый экран — без построения pydantic-моделей на каждый клик
+
+class Screen(NamedTuple):
+    text: str
+    # Готовые kwargs для edit_text / answer: parse_mode, reply_markup
+    options: MappingProxyType
+
+
+def screen(text, reply_markup=None, parse_mode=None) -> Screen:
+    options = {}
+    if reply_markup is not None:
+        options["reply_markup"] = reply_markup
+    if parse_mode is not None:
+        options["parse_mode"] = parse_mode
+    return Screen(text, MappingProxyType(options))
+
+
+def _keyboard(*rows) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[list(row) for row in rows])
+
+
+def _button(text, action, *args) -> InlineKeyboardButton:
+    return InlineKeyboardButton(text=text, callback_data=encode(action, *args))
+
+
+# === КЛАВИАТУРЫ ===
+START_KEYBOARD = _keyboard(
+    [_button("📋 Условия работы", "info_conditions")],
+    [_button("🛂 Требования", "info_requirements")],
+    [_button("💰 Примерный доход", "calc_income")],
+)
+
+AGE_KEYBOARD = _keyboard(
+    [_button("Да✅", "age_yes"), _button("Нет❌", "age_no")],
+)
+
+BACK_TO_AGE_KEYBOARD = _keyboard(
+    [_button("⬅ Назад", "back_to_age")],
+)
+
+CITIZENSHIP_KEYBOARD = _keyboard(
+    [_button("🇷🇺 Россия", "citizenship", "ru")],
+    [_button("🇧🇾 Беларусь", "citizenship", "by")],
+    [_button("🇰🇿 Казахстан", "citizenship", "kz")],
+    [_button("🇦🇲 Армения", "citizenship", "am")],
+    [_button("🇰🇬 Кыргызстан", "citizenship", "kg")],
+    [_button("Другое", "citizenship", "other")],
+)
+
+DELIVERY_KEYBOARD = _keyboard(
+    [_button("🧍 Пешком", "delivery", "foot")],
+    [_button("🚲 Вело", "delivery", "bike")],
+    [_button("🚗 Авто", "delivery", "car")],
+)
+
+INCOME_KEYBOARD = _keyboard(
+    [_button("📝 Хочу откликнуться", "send_lead")],
+    [_button("🎁 Бонусы для курьеров", "income_bonus"), _button("❓ Частые вопросы", "income_faq")],
+    [_button("🔄 Рассчитать ещё раз", "income_recalc")],
+)
+
+# Под расчётом дохода — ещё и пересчёт на своё число смен в неделю
+SHIFT_OPTIONS = (2, 3, 5, 6)
+INCOME_RESULT_KEYBOARD = _keyboard(
+    [_button(f"{n} смен/нед" if n > 4 else f"{n} смены/нед", "shifts", n) for n in SHIFT_OPTIONS],
+    *INCOME_KEYBOARD.inline_keyboard,
+)
+
+LEAD_SENT_KEYBOARD = _keyboard(
+    [InlineKeyboardButton(
+        text="📝 Заполнить анкету",
+        url="https://reg.eda.yandex.ru/?advertisement_campaign=forms_for_agents&user_invite_code=4fd8c46d41724e86a4448b0367951ddb&utm_content=blank"
+    )],
+    [_button("⬅ Вернуться в начало", "back_to_start_after_lead")],
+)
+
+
+# === ЭКРАНЫ ===
+START = screen(
+    "👋 Привет!\n\n"
+    "Я информационный бот о работе курьером доставки еды.\n\n"
+    "Могу рассказать про:\n"
+    "• условия работы\n"
+    "• требования\n"
+    "• формат занятости\n"
+    "• примерный доход в вашем городе\n\n"
+    "Выберите, что хотите посмотреть 👇",
+    reply_markup=START_KEYBOARD,
+)
+
+MENU_AFTER_LEAD = screen(
+    "Вы снова в меню бота. Могу рассказать про:\n"
+    "• условия работы\n"
+    "• требования\n"
+    "• примерный доход в вашем городе\n\n"
+    "Выберите опцию 👇",
+    reply_markup=START_KEYBOARD,
+)
+
+CONDITIONS = screen(
+    "📋 <b>Условия работы курьером</b>\n\n"
+    "• Гибкий график — выбираете в какой день и сколько часов работать\n"
+    "• Можно совмещать с учёбой или основной работой по ТК РФ, оформление через самозанятость или ГПХ\n"
+    "• Форматы доставки: пешком, вело или авто\n"
+    "• Работа с заказами через приложение\n\n"
+    "Доход зависит от города, количества заказов и формата доставки.",
+    reply_markup=_keyboard(
+        [_button("💰 Посмотреть доход", "calc_income")],
+        [_button("⬅ Назад", "back_to_start")],
+    ),
+    parse_mode="HTML",
+)
+
+REQUIREMENTS = screen(
+    "🛂 <b>Требования</b>\n\n"
+    "• Возраст от 18 лет\n"
+    "• Знание русского языка\n"
+    "• Смартфон Android (версия не ниже 7.0) или iOS (версия не ниже 13.0) для работы с заказами\n"
+    "• Умение пользоваться навигатором \n\n"
+    "Точные условия зависят от города.",
+    reply_markup=_keyboard(
+        [_button("💰 Рассчитать доход", "calc_income")],
+        [_button("⬅ Назад", "back_to_start")],
+    ),
+    parse_mode="HTML",
+)
+
+AGE_QUESTION = screen(
+    "Чтобы рассчитать примерный доход, уточним несколько деталей.\n\n"
+    "Вам есть 18 лет?",
+    reply_markup=AGE_KEYBOARD,
+)
+
+UNDERAGE = screen(
+    "Если тебе есть 16 лет, ты можешь работать курьером в некоторых городах:\n"
+    "<b>Нижний Новгород, Самара, Ростов-на-Дону, Челябинск, Тверь, Сургут, Тюмень, Астрахань, Владивосток, Томск, Иваново, Сочи, Ставрополь, Ижевск, Калуга, Липецк, Барнаул, Сергиев Посад, Нижнекамск, Красноярск, Воронеж, Екатеринбург, Казань, Новороссийск, Тула, Набережные Челны, Ульяновск, Москва+МО, Санкт-Петербург+ЛО</b>\n\n"
+    "Для оформления потребуется <b>свидетельство о рождении</b> и <b>согласие родителей</b>.\n\n",
+    reply_markup=BACK_TO_AGE_KEYBOARD,
+    parse_mode="HTML",
+)
+
+CITIZENSHIP = screen(
+    "Выберите ваше гражданство",
+    reply_markup=CITIZENSHIP_KEYBOARD,
+)
+
+# Клавиатура городов динамическая, поэтому здесь только текст
+CITY_PROMPT_TEXT = (
+    "В каком городе вы планируете выполнять доставки?\n"
+    "Выберите из списка или напишите название города ✍️"
+)
+CITY_SEARCH_TEXT = "Нашёл такие города — выберите свой:"
+CITY_NOT_FOUND_TEXT = "Не нашёл такой город 🤔 Попробуйте написать иначе или выберите из списка:"
+
+DELIVERY = screen(
+    "Остался последний вопрос — и покажу доход\n"
+    "Какой формат доставки вам подходит?",
+    reply_markup=DELIVERY_KEYBOARD,
+)
+
+DELIVERY_RECALC = screen(
+    "Какой формат доставки вам подходит?",
+    reply_markup=DELIVERY_KEYBOARD,
+)
+
+NO_CITY = screen(
+    "К сожалению, в вашем городе пока нет найма 😔",
+)
+
+LEAD_SENT = screen(
+    "Двигаемся дальше 😊\n\n"
+    "➡️ Следующий шаг — короткая анкета и мини-обучение по работе с заказами.\n"
+    "Ничего сложного, обычно занимает 15 минут.\n",
+    reply_markup=LEAD_SENT_KEYBOARD,
+    parse_mode="HTML",
+)
+
+INCOME_BONUS = screen(
+    "🎁 <b>Бонусы для курьеров</b>\n\n"
+    "• Яндекс Байк за 1 ₽\n"
+    "• Комбо-обед за 95 ₽\n"
+    "• Скидка 20% в Яндекс Лавке\n"
+    "• Яндекс Плюс в подарок\n"
+    "• 100% чаевых ваши\n"
+    "• Промокод на Еду 300 ₽\n"
+    "• Скидка 10% в Ленте\n"
+    "• Бери Заряд бесплатно\n"
+    "• Юридическая поддержка",
+    reply_markup=INCOME_KEYBOARD,
+    parse_mode="HTML",
+)
+
+INCOME_FAQ = screen(
+    "❓ <b>Частые вопросы</b>\n\n"
+    "• 🏫 <b>Нет опыта?</b>\n"
+    "Не переживайте, обучение предоставляется. Освоиться быстро!\n\n"
+    "• ⏰ <b>Какой график?</b>\n"
+    "Свободный режим: сами выбираете удобные слоты. Сами выбираете в какой день работать. Слот - это смена на несколько часов. Можно отработать один слот или несколько сразу.\n\n"
+    "• 💪 <b>Физически тяжело?</b>\n"
+    "Лёгкие доставки, выбираете заказы по силам.\n\n"
+    "• 📍 <b>Сложно ориентироваться?</b>\n"
+    "Есть удобное навигационное приложение.\n\n"
+    "• 🚶‍♂️ <b>Нет транспорта?</b>\n"
+    "Можно пешком, на вело или общественном транспорте.\n\n"
+    "• 🛡️ <b>Безопасно?</b>\n"
+    "Страхование и поддержка на маршруте гарантируют безопасность.\n\n",
+    reply_markup=INCOME_KEYBOARD,
+    parse_mode="HTML",
+)
+
+# Реестр по callback_data для экранов, которые показываются «как есть»
+SCREENS_BY_CALLBACK = MappingProxyType({
+    "info_conditions": CONDITIONS,
+    "info_requirements": REQUIREMENTS,
+    "income_bonus": INCOME_BONUS,
+    "income_faq": INCOME_FAQ,
+})
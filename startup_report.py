@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+import logging
+import builtins
+logger = logging.getLogger(__name__)
+
+
+# Отчёт о времени старта в духе `python -X importtime`: STARTUP_REPORT=1
+STARTUP_REPORT = os.environ.get("STARTUP_REPORT") == "1"
+STARTUP_REPORT_TOP = int(os.environ.get("STARTUP_REPORT_TOP", "15"))
+
+_started = time.perf_counter()
+_imports: dict[str, float] = {}   # модуль верхнего уровня -> сек (вместе с зависимостями)
+_stages: list[tuple[str, float]] = []
+_original_import = builtins.__import__
+_depth = 0
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    global _depth
+    # Относительные и уже загруженные импорты ничего не стоят — не меряем
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    _depth += 1
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _depth -= 1
+        if _depth == 0:
+            _imports[name] = _imports.get(name, 0.0) + time.perf_counter() - start
+
+
+def mark(stage: str):
+    if STARTUP_REPORT:
+        _stages.append((stage, time.perf_counter() - _started))
+
+
+def report():
+    global STARTUP_REPORT
+    if not STARTUP_REPORT:
+        return
+    builtins.__import__ = _original_import
+    STARTUP_REPORT = False
+
+    lines = [f"Startup report: {time.perf_counter() - _started:.3f}s total"]
+    for stage, at in _stages:
+        lines.append(f"  stage {stage:<30} +{at:.3f}s")
+    top = sorted(_imports.items(), key=lambda kv: kv[1], reverse=True)[:STARTUP_REPORT_TOP]
+    for name, spent in top:
+        lines.append(f"  import {name:<29} {spent * 1000:8.1f} ms")
+    logger.info("\n".join(lines))
+
+
+if STARTUP_REPORT:
+    builtins.__import__ = _timed_import
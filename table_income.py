@@ -1,80 +1,673 @@
 import json
-import gspread
-from google.oauth2.service_account import Credentials
+import asyncio
 import threading
 import time
-import base64
 import os
 import logging
-from google_client import get_google_client
+import hashlib
+import random
+import bisect
+import warnings
+from types import MappingProxyType
+from typing import NamedTuple
+import numpy as np
+from metrics import histogram, timed
+from google_client import get_sheets_client, sheets_breaker
+from workers import is_multi_worker, try_become_leader
 logger = logging.getLogger(__name__)
 
+REFRESH_LATENCY = histogram("income_refresh_seconds", "Income cache refresh duration by outcome")
+
 
 # === 6. КЭШ ===
-average_income_ya_eda = []
+class IncomeRecord(NamedTuple):
+    # Строка таблицы, разобранная один раз при загрузке: в запросах только чтение готовых полей
+    city: str
+    delivery: str
+    day: int
+    month_avg: int
+    month_max: int
+    eaes: bool
+    not_rf: bool
+    # Суммы с пробелами между разрядами — как их показывает бот
+    day_text: str
+    month_avg_text: str
+    month_max_text: str
+    # Необязательные колонки для оценок без точного совпадения
+    region: str = ""
+    lat: float | None = None
+    lon: float | None = None
+
+
+class IncomeSnapshot(NamedTuple):
+    # Неизменяемый снимок таблицы: пересобирается целиком при обновлении,
+    # читатели получают ссылку без копирования и без блокировок
+    version: int
+    records: tuple                        # IncomeRecord
+    by_key: MappingProxyType              # (city, delivery) -> IncomeRecord
+    cities_by_type: MappingProxyType      # citizenship_type -> tuple городов
+    fetched_at: float = 0.0               # когда данные последний раз сверялись с таблицей
+    table: "IncomeTable | None" = None    # та же таблица в массивах NumPy для оценок
+    search: "CitySearchIndex | None" = None  # поиск города по введённому тексту
+
+    @property
+    def age(self) -> float | None:
+        # Возраст данных в секундах; None — данных ещё не было
+        return time.time() - self.fetched_at if self.fetched_at else None
+
+
+CITIZENSHIP_TYPES = ("rf", "eaes", "not_rf")
+
+_EMPTY_SNAPSHOT = IncomeSnapshot(
+    version=0,
+    records=(),
+    by_key=MappingProxyType({}),
+    cities_by_type=MappingProxyType({t: () for t in CITIZENSHIP_TYPES}),
+)
+
+INCOME_SPREADSHEET = "average_income_ya_eda"
+# ID таблицы избавляет от поиска по названию в Drive при каждом старте
+INCOME_SPREADSHEET_ID = os.environ.get("INCOME_SPREADSHEET_ID")
+# Без имени листа — первый лист таблицы
+INCOME_RANGE = "A:Z"
+REFRESH_INTERVAL = 900
+# Неудачное обновление повторяем раньше: 10 с, 20 с, 40 с ... до REFRESH_INTERVAL, со случайным разбросом
+REFRESH_RETRY_BASE = 10
+# Если битых строк больше этой доли (или годных нет вовсе), обновление считается неудачным
+MAX_REJECTED_SHARE = 0.5
+INCOME_CACHE_PATH = os.environ.get("INCOME_CACHE_PATH", "income_cache.json")
+# Файл-флаг: воркер, получивший /refresh_income, просит лидера обновить таблицу
+REFRESH_REQUEST_PATH = INCOME_CACHE_PATH + ".refresh"
+# Как часто воркеры (и лидер — в поисках флага) проверяют файл снимка
+WORKER_POLL_INTERVAL = 5
+
+_snapshot = _EMPTY_SNAPSHOT
+_refresh_event = asyncio.Event()
+_refresher_task: asyncio.Task | None = None
 _init_started = False
 _init_lock = threading.Lock()
-_data_lock = threading.Lock()
+# После остановки сервис не поднимается заново (например, scrape /metrics во время shutdown)
+_stopped = False
+_disk_mtime = None
+# modifiedTime и хэш содержимого последней загруженной версии таблицы
+_last_modified = None
+_last_hash = None
+
+
+_FLAGS = {"TRUE": True, "FALSE": False, "": False}
+
+
+def format_money(value: int) -> str:
+    return f"{value:,}".replace(",", " ")
+
+
+def _parse_amount(value) -> int:
+    if isinstance(value, bool):
+        raise ValueError(f"bad amount {value!r}")
+    if isinstance(value, (int, float)):
+        # Без форматирования Sheets отдаёт числа, в том числе 1500.0
+        amount = int(round(value))
+    else:
+        amount = int(str(value).replace(" ", "").replace("\xa0", ""))
+    if amount < 0:
+        raise ValueError(f"negative amount {value!r}")
+    return amount
+
+
+def parse_income_row(r: dict) -> IncomeRecord:
+    """Проверяет строку таблицы и превращает её в IncomeRecord; ValueError — строка битая."""
+    city = str(r.get("city", "")).strip()
+    delivery = str(r.get("delivery", "")).strip()
+    if not city or not delivery:
+        raise ValueError("empty city or delivery")
+    day = _parse_amount(r.get("day"))
+    month_avg = _parse_amount(r.get("month_avg"))
+    month_max = _parse_amount(r.get("month_max"))
+    try:
+        eaes = _FLAGS[str(r.get("eaes", "")).strip().upper()]
+        not_rf = _FLAGS[str(r.get("not_rf", "")).strip().upper()]
+    except KeyError as e:
+        raise ValueError(f"bad citizenship flag {e}") from None
+    lat, lon = _parse_coordinate(r.get("lat"), 90), _parse_coordinate(r.get("lon"), 180)
+    return IncomeRecord(
+        city, delivery, day, month_avg, month_max, eaes, not_rf,
+        format_money(day), format_money(month_avg), format_money(month_max),
+        str(r.get("region", "")).strip(), lat, lon,
+    )
+
+
+def _parse_coordinate(value, limit: float) -> float | None:
+    if value is None or str(value).strip() == "":
+        return None
+    coordinate = float(str(value).replace(",", "."))
+    if not -limit <= coordinate <= limit:
+        raise ValueError(f"coordinate out of range {value!r}")
+    return coordinate
+
+
+def build_snapshot(rows: list[dict], version: int, fetched_at: float = 0.0) -> IncomeSnapshot:
+    records = []
+    by_key = {}
+    cities = {t: set() for t in CITIZENSHIP_TYPES}
+    for r in rows:
+        try:
+            rec = parse_income_row(r)
+        except (ValueError, TypeError, AttributeError) as e:
+            logger.warning("Skip malformed income row %r: %s", r, e)
+            continue
+        key = (rec.city, rec.delivery)
+        if key in by_key:
+            logger.warning("Duplicate income row for %s/%s, keeping the last one", *key)
+        by_key[key] = rec
+        records.append(rec)
+        cities["rf"].add(rec.city)
+        if rec.eaes:
+            cities["eaes"].add(rec.city)
+        if rec.not_rf:
+            cities["not_rf"].add(rec.city)
+
+    if len(records) != len(rows):
+        logger.warning("Income snapshot: %d rows rejected of %d", len(rows) - len(records), len(rows))
+    return IncomeSnapshot(
+        version=version,
+        records=tuple(records),
+        by_key=MappingProxyType(by_key),
+        cities_by_type=MappingProxyType({t: tuple(sorted(c)) for t, c in cities.items()}),
+        fetched_at=fetched_at,
+        table=build_table(records),
+        search=CitySearchIndex(cities["rf"], cities),
+    )
+
+
+# ===============================
+# ПОИСК ГОРОДА ПО ТЕКСТУ
+# ===============================
+
+# Русский текст, набранный в английской раскладке: "vjcrdf" -> "москва"
+_LAYOUT = str.maketrans(
+    "qwertyuiop[]asdfghjkl;'zxcvbnm,.`",
+    "йцукенгшщзхъфывапролджэячсмитьбюё",
+)
+_PUNCTUATION = str.maketrans({c: " " for c in "-–—.,()/\\\"'«»"})
+MIN_TRIGRAM_SCORE = 0.35
+
+
+def normalize_city(text: str) -> str:
+    # Регистр, ё/е, дефисы и лишние пробелы не важны: "санкт петербург" == "Санкт-Петербург"
+    text = text.lower().replace("ё", "е").translate(_PUNCTUATION)
+    return " ".join(text.split())
+
+
+def _trigrams(text: str) -> set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class CitySearchIndex:
+    """
+    Индекс городов для поиска по началу названия (или любого слова в нём)
+    и по триграммам — для опечаток. Строится один раз на версию таблицы.
+    """
+
+    __slots__ = ("cities", "_prefixes", "_trigram_ids", "_trigram_counts", "_allowed")
+
+    def __init__(self, cities, cities_by_type: dict):
+        self.cities = tuple(sorted(cities))
+        ids = {c: i for i, c in enumerate(self.cities)}
+        # (слово или всё название, id) по алфавиту — префиксы ищутся бинарным поиском
+        prefixes = []
+        trigram_ids: dict[str, list[int]] = {}
+        self._trigram_counts = []
+        for i, city in enumerate(self.cities):
+            name = normalize_city(city)
+            prefixes.append((name, i))
+            prefixes.extend((word, i) for word in name.split()[1:])
+            grams = _trigrams(name)
+            self._trigram_counts.append(len(grams))
+            for gram in grams:
+                trigram_ids.setdefault(gram, []).append(i)
+        prefixes.sort()
+        self._prefixes = prefixes
+        self._trigram_ids = trigram_ids
+        self._allowed = {t: frozenset(ids[c] for c in group) for t, group in cities_by_type.items()}
+
+    def search(self, query: str, citizenship_type: str, limit: int = 8) -> list[str]:
+        allowed = self._allowed.get(citizenship_type, frozenset())
+        query = normalize_city(query)
+        if not query or not allowed:
+            return []
+        scores = self._score(query)
+        if not scores and query.isascii():
+            scores = self._score(normalize_city(query.translate(_LAYOUT)))
+        ranked = sorted(
+            (i for i in scores if i in allowed),
+            key=lambda i: (-scores[i], len(self.cities[i]), self.cities[i]),
+        )
+        return [self.cities[i] for i in ranked[:limit]]
+
+    def _score(self, query: str) -> dict[int, float]:
+        scores: dict[int, float] = {}
+        # Совпадение по началу — всегда выше любой триграммной похожести
+        start = bisect.bisect_left(self._prefixes, (query, -1))
+        for token, i in self._prefixes[start:]:
+            if not token.startswith(query):
+                break
+            scores[i] = 2.0 if token == query else 1.5
+
+        # Опечатки: коэффициент Дайса по общим триграммам
+        grams = _trigrams(query)
+        hits: dict[int, int] = {}
+        for gram in grams:
+            for i in self._trigram_ids.get(gram, ()):
+                hits[i] = hits.get(i, 0) + 1
+        for i, common in hits.items():
+            score = 2 * common / (len(grams) + self._trigram_counts[i])
+            if score >= MIN_TRIGRAM_SCORE and score > scores.get(i, 0):
+                scores[i] = score
+        return scores
+
+
+# ===============================
+# ТАБЛИЦА В МАССИВАХ И ОЦЕНКИ
+# ===============================
+# Для пар (город, доставка), которых нет в таблице, доход оценивается по
+# соседним данным. Все расчёты — векторные операции над массивами
+# города × формат доставки, собранными один раз на версию таблицы
+
+DELIVERIES = ("foot", "bike", "car")
+DELIVERY_INDEX = MappingProxyType({d: i for i, d in enumerate(DELIVERIES)})
+METRICS = ("day", "month_avg", "month_max")
+WEEKS_PER_MONTH = 52 / 12
+EARTH_RADIUS_KM = 6371.0
+
+
+class IncomeTable(NamedTuple):
+    cities: tuple
+    city_index: MappingProxyType          # город -> строка массивов
+    region_names: tuple
+    regions: np.ndarray                   # (города,) индекс в region_names, -1 — регион не указан
+    coords: np.ndarray                    # (города, 2) широта и долгота в радианах, NaN — нет
+    values: np.ndarray                    # (города, доставки, METRICS), NaN — нет строки в таблице
+    delivery_ratio: np.ndarray            # (доставки, доставки): медиана дохода i / доход j по городам
+    bands: np.ndarray                     # (3, доставки): 25/50/75-й перцентиль дневного дохода по стране
+
+
+class IncomeEstimate(NamedTuple):
+    day: int
+    month_avg: int
+    month_max: int
+    # exact | other_delivery | nearest | region | country
+    source: str
+    # Город или регион, по которому сделана оценка
+    basis: str
+    # Типичный диапазон дневного дохода в этом формате по стране (25–75-й перцентиль)
+    band_low: int
+    band_high: int
+    # Суммы для показа: у точной строки — готовые поля IncomeRecord
+    day_text: str
+    month_avg_text: str
+    month_max_text: str
+
+
+def _nan_reduce(func, values, **kwargs):
+    # Пустые срезы дают NaN — это ожидаемо, предупреждения numpy не нужны
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return func(values, **kwargs)
+
+
+def build_table(records: list[IncomeRecord]) -> IncomeTable | None:
+    records = [r for r in records if r.delivery in DELIVERY_INDEX]
+    if not records:
+        return None
+    cities = tuple(dict.fromkeys(r.city for r in records))
+    city_index = {c: i for i, c in enumerate(cities)}
+    region_names = tuple(sorted({r.region for r in records if r.region}))
+    region_index = {name: i for i, name in enumerate(region_names)}
+
+    values = np.full((len(cities), len(DELIVERIES), len(METRICS)), np.nan)
+    regions = np.full(len(cities), -1, dtype=np.int32)
+    coords = np.full((len(cities), 2), np.nan)
+    for r in records:
+        i = city_index[r.city]
+        values[i, DELIVERY_INDEX[r.delivery]] = (r.day, r.month_avg, r.month_max)
+        if r.region:
+            regions[i] = region_index[r.region]
+        if r.lat is not None and r.lon is not None:
+            coords[i] = np.radians((r.lat, r.lon))
+
+    day = values[:, :, 0]
+    # ratio[i, j] — во сколько раз доход в формате i выше, чем в формате j того же города
+    positive = np.where(day > 0, day, np.nan)
+    delivery_ratio = _nan_reduce(np.nanmedian, positive[:, :, None] / positive[:, None, :], axis=0)
+    bands = _nan_reduce(np.nanpercentile, day, q=(25, 50, 75), axis=0)
+    return IncomeTable(
+        cities, MappingProxyType(city_index), region_names, regions, coords,
+        values, delivery_ratio, bands,
+    )
+
+
+def _distances_km(coords: np.ndarray, origin: np.ndarray) -> np.ndarray:
+    # Гаверсинус сразу до всех городов
+    dlat = coords[:, 0] - origin[0]
+    dlon = coords[:, 1] - origin[1]
+    a = np.sin(dlat / 2) ** 2 + np.cos(origin[0]) * np.cos(coords[:, 0]) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def estimate_from_table(table: IncomeTable, city: str, delivery: str) -> IncomeEstimate | None:
+    d = DELIVERY_INDEX.get(delivery)
+    if d is None:
+        return None
+    i = table.city_index.get(city)
+    has = ~np.isnan(table.values[:, d, 0])
+    found = source = basis = None
+
+    if i is not None and has[i]:
+        found, source, basis = table.values[i, d], "exact", city
+    if found is None and i is not None:
+        # Другие форматы того же города, пересчитанные через типичное соотношение форматов
+        scaled = table.values[i] * table.delivery_ratio[d][:, None]
+        if not np.isnan(scaled[:, 0]).all():
+            found, source, basis = _nan_reduce(np.nanmean, scaled, axis=0), "other_delivery", city
+    if found is None and i is not None and not np.isnan(table.coords[i]).any():
+        distances = _distances_km(table.coords, table.coords[i])
+        distances[~has | np.isnan(distances)] = np.inf
+        nearest = int(np.argmin(distances))
+        if np.isfinite(distances[nearest]):
+            found, source, basis = table.values[nearest, d], "nearest", table.cities[nearest]
+    if found is None and i is not None and table.regions[i] >= 0:
+        in_region = has & (table.regions == table.regions[i])
+        if in_region.any():
+            found = np.median(table.values[in_region, d], axis=0)
+            source, basis = "region", table.region_names[table.regions[i]]
+    if found is None and has.any():
+        found, source, basis = np.median(table.values[has, d], axis=0), "country", ""
+    if found is None:
+        return None
+
+    day, month_avg, month_max = (int(round(v)) for v in found)
+    return IncomeEstimate(
+        day, month_avg, month_max, source, basis, *_band(table, d, day),
+        format_money(day), format_money(month_avg), format_money(month_max),
+    )
+
+
+def _band(table: IncomeTable, d: int, day: int) -> tuple[int, int]:
+    low, _, high = table.bands[:, d]
+    if np.isnan(low):
+        # В этом формате по стране нет ни одной строки — диапазон только из оценки
+        return day, day
+    return int(round(low)), int(round(high))
+
+
+def shift_estimates(day: int, shifts_per_week) -> np.ndarray:
+    """Доход в месяц при заданном числе смен в неделю (можно сразу для нескольких вариантов)."""
+    return np.rint(day * np.asarray(shifts_per_week, dtype=float) * WEEKS_PER_MONTH).astype(int)
+
+
+def _load_disk_snapshot():
+    global _snapshot, _disk_mtime
+    try:
+        with open(INCOME_CACHE_PATH, "rb") as f:
+            mtime = os.fstat(f.fileno()).st_mtime_ns
+            payload = json.load(f)
+        # Данные не старше записи файла; сверки без изменений лидер отмечает в файле .checked
+        fetched_at = max(mtime / 1e9, _checked_at() or 0.0)
+        _snapshot = build_snapshot(payload["records"], _snapshot.version + 1, fetched_at)
+        _disk_mtime = mtime
+        logger.info(
+            "Income cache loaded from disk: %d records", len(payload["records"])
+        )
+        return payload.get("modified"), payload.get("hash")
+    except FileNotFoundError:
+        return None, None
+    except Exception:
+        logger.exception("Failed to load income cache from disk")
+        return None, None
+
+
+def _disk_snapshot_changed() -> bool:
+    try:
+        return os.stat(INCOME_CACHE_PATH).st_mtime_ns != _disk_mtime
+    except FileNotFoundError:
+        return False
+
+
+def _checked_path() -> str:
+    return INCOME_CACHE_PATH + ".checked"
+
+
+def _checked_at() -> float | None:
+    try:
+        return os.stat(_checked_path()).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def _touch_disk_snapshot():
+    # Данные подтверждены, но не изменились: сдвигаем только время сверки.
+    # Сам файл снимка не трогаем — иначе воркеры пересобирали бы снимок без изменений
+    global _snapshot
+    _snapshot = _snapshot._replace(fetched_at=time.time())
+    try:
+        with open(_checked_path(), "a"):
+            pass
+        os.utime(_checked_path())
+    except OSError:
+        logger.warning("Failed to mark income cache as checked", exc_info=True)
+
+
+def _sync_checked_at():
+    # Воркер: лидер сверился с таблицей без изменений — обновляем только возраст данных
+    global _snapshot
+    checked_at = _checked_at()
+    if checked_at is not None and _snapshot.version and checked_at > _snapshot.fetched_at:
+        _snapshot = _snapshot._replace(fetched_at=checked_at)
+
+
+def _save_disk_snapshot(records, modified, content_hash):
+    # Пишем во временный файл и атомарно подменяем, чтобы не оставить битый кэш
+    tmp_path = INCOME_CACHE_PATH + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"modified": modified, "hash": content_hash, "records": records},
+                f,
+                ensure_ascii=False,
+                separators=(",", ":"),
+            )
+        os.replace(tmp_path, INCOME_CACHE_PATH)
+    except Exception:
+        logger.exception("Failed to save income cache to disk")
+
+
+_SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets.readonly",
+    "https://www.googleapis.com/auth/drive.readonly"
+]
+
+
+async def _update_income(force: bool = False) -> str:
+    global _snapshot, _last_modified, _last_hash
+    if not sheets_breaker.allow():
+        # Google недоступен — не тратим квоту, пользователи читают последний удачный снимок
+        logger.info("Income refresh skipped: Sheets circuit is open")
+        REFRESH_LATENCY.observe(0.0, outcome="skipped")
+        return "skipped"
+    started = time.perf_counter()
+    outcome = "unchanged"
+    try:
+        client = get_sheets_client(_SCOPES)
+        spreadsheet_id = await client.spreadsheet_id(INCOME_SPREADSHEET, INCOME_SPREADSHEET_ID)
+
+        try:
+            # Дешёвый запрос к Drive: только время последнего изменения файла
+            with timed("drive_modified_time"):
+                modified = await client.modified_time(spreadsheet_id)
+        except Exception:
+            logger.warning("Failed to get modifiedTime, falling back to content hash")
+            modified = None
+
+        if not force and modified is not None and modified == _last_modified:
+            logger.debug("Income sheet not modified since %s", modified)
+            _touch_disk_snapshot()
+            return outcome
+
+        with timed("sheets_batch_get"):
+            (values,) = await client.batch_get(spreadsheet_id, [INCOME_RANGE])
+        content_hash = hashlib.sha1(
+            json.dumps(values, ensure_ascii=False).encode("utf-8")
+        ).hexdigest()
+
+        if not force and content_hash == _last_hash:
+            logger.debug("Income sheet content unchanged")
+            _last_modified = modified
+            _touch_disk_snapshot()
+            return outcome
+
+        headers, rows = (values[0], values[1:]) if values else ([], [])
+        records = [dict(zip(headers, row)) for row in rows]
+
+        snapshot = build_snapshot(records, _snapshot.version + 1, time.time())
+        rejected = len(records) - len(snapshot.records)
+        if not snapshot.records or rejected > len(records) * MAX_REJECTED_SHARE:
+            # Лист очищен или переименованы колонки — это сбой, а не новые данные:
+            # остаётся последний удачный снимок, и на диске тоже
+            raise ValueError(f"income sheet rejected: {rejected} of {len(records)} rows invalid")
+
+        # Атомарная подмена ссылки — читатели видят либо старый, либо новый снимок
+        _snapshot = snapshot
+        _last_modified = modified
+        _last_hash = content_hash
+        await asyncio.to_thread(_save_disk_snapshot, records, modified, content_hash)
+
+        outcome = "updated"
+        logger.info(
+        "Income cache updated: %d records",
+        len(records)
+        )
+    except Exception:
+        outcome = "failed"
+        logger.exception("Failed to update income cache")
+    finally:
+        REFRESH_LATENCY.observe(time.perf_counter() - started, outcome=outcome)
+        if outcome == "failed":
+            sheets_breaker.failure()
+        else:
+            sheets_breaker.success()
+    return outcome
+
+
+async def _refresher():
+    global _last_modified, _last_hash
+    # В Google ходит только лидер; остальные воркеры подхватывают файл снимка,
+    # который он записал. Один воркер — всегда лидер, и цикл вырождается в прежний
+    poll_interval = WORKER_POLL_INTERVAL if is_multi_worker() else REFRESH_INTERVAL
+    # Первоначальная проверка при старте — сразу, уже в фоне; пользователи читают снимок с диска
+    next_refresh = 0.0
+    failures = 0
+    forced = False
+    while True:
+        timeout = poll_interval
+        if try_become_leader():
+            if os.path.exists(REFRESH_REQUEST_PATH):
+                os.remove(REFRESH_REQUEST_PATH)
+                forced = True
+            if forced or time.monotonic() >= next_refresh:
+                if await _update_income(force=forced) in ("failed", "skipped"):
+                    failures += 1
+                    delay = min(REFRESH_INTERVAL, REFRESH_RETRY_BASE * 2 ** (failures - 1))
+                    delay *= random.uniform(0.5, 1.0)
+                else:
+                    failures = 0
+                    delay = REFRESH_INTERVAL
+                next_refresh = time.monotonic() + delay
+            timeout = max(0.0, min(poll_interval, next_refresh - time.monotonic()))
+        else:
+            if forced:
+                open(REFRESH_REQUEST_PATH, "a").close()
+            if _disk_snapshot_changed():
+                _last_modified, _last_hash = await asyncio.to_thread(_load_disk_snapshot)
+            else:
+                _sync_checked_at()
+
+        # Просыпаемся по таймеру или по запросу администратора
+        try:
+            await asyncio.wait_for(_refresh_event.wait(), timeout)
+            forced = True
+        except asyncio.TimeoutError:
+            forced = False
+        _refresh_event.clear()
+
 
 def init_income_service():
-    global _init_started
+    global _init_started, _last_modified, _last_hash, _refresher_task
     # 🔒 защита от повторного запуска
     with _init_lock:
-        if _init_started:
-            return
-        _init_started = True
-
-        #b64_key = os.environ.get("GOOGLE_CRED_JSON_IN_BASE_64")
-        #decoded_json = base64.b64decode(b64_key).decode("utf-8")
-        #key_dict = json.loads(decoded_json)
-        # ⬇️ дальше БЕЗ lock
-        decoded_json = base64.b64decode(
-            os.environ["GOOGLE_CRED_JSON_IN_BASE_64"]
-        ).decode("utf-8")
-        key_dict = json.loads(decoded_json)
-
-        # ✅ Добавляем нужные права
-        scopes = [
-            "https://www.googleapis.com/auth/spreadsheets.readonly",
-            "https://www.googleapis.com/auth/drive.readonly"
-        ]
-
-        # Авторизация
-        client = get_google_client(scopes)
-
-        # Функция обновления данных
-        def update_income():
-            nonlocal client
+        if not _init_started:
+            _init_started = True
+            # ⚡ Сначала поднимаем последний удачный снимок с диска — это миллисекунды
+            _last_modified, _last_hash = _load_disk_snapshot()
+
+        # Сверка с таблицей — фоновая задача в event loop; без loop (скрипты) хватает снимка с диска
+        if _refresher_task is None and not _stopped:
             try:
-                sheet = client.open("average_income_ya_eda").sheet1
-                records = sheet.get_all_records()
-                
-                with _data_lock:
-                    average_income_ya_eda.clear()
-                    average_income_ya_eda.extend(records)
-
-                logger.info(
-                "Income cache updated: %d records",
-                len(records)
-                )
-            except Exception:
-                logger.exception("Failed to update income cache")
-                
-        # Первоначальный запрос при старте
-        update_income()
-
-        def loop():
-            while True:
-                time.sleep(900)
-                update_income()
-
-        threading.Thread(target=loop, daemon=True, name="income-cache-updater").start()
-
-def get_average_income():
-    if not _init_started:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            _refresher_task = asyncio.create_task(_refresher(), name="income-cache-updater")
+
+
+async def stop_income_service():
+    global _refresher_task, _stopped
+    _stopped = True
+    if _refresher_task is None:
+        return
+    _refresher_task.cancel()
+    try:
+        await _refresher_task
+    except asyncio.CancelledError:
+        pass
+    _refresher_task = None
+
+
+def request_income_refresh():
+    """Внеочередное обновление кэша (например, по команде администратора)."""
+    if _refresher_task is None:
+        init_income_service()
+        return
+    _refresh_event.set()
+
+
+def get_income_snapshot() -> IncomeSnapshot:
+    if _refresher_task is None and not _stopped:
         init_income_service()  # 🔒 безопасно, т.к. есть lock
-    # 🔒 возвращаем копию
-    with _data_lock:
-        return list(average_income_ya_eda)
+    return _snapshot
+
+
+def estimate_income(city: str, delivery: str) -> IncomeEstimate | None:
+    """Доход для пары (город, доставка); если точной строки нет — оценка по соседним данным."""
+    snapshot = get_income_snapshot()
+    table = snapshot.table
+    d = DELIVERY_INDEX.get(delivery)
+    if table is None or d is None:
+        return None
+    record = snapshot.by_key.get((city, delivery))
+    if record is not None:
+        # Точная строка таблицы — один поиск по словарю, без расчётов над массивами
+        return IncomeEstimate(
+            record.day, record.month_avg, record.month_max, "exact", city,
+            *_band(table, d, record.day),
+            record.day_text, record.month_avg_text, record.month_max_text,
+        )
+    return estimate_from_table(table, city, delivery)
+
+
+def search_cities(query: str, citizenship_type: str, limit: int = 8) -> list[str]:
+    search = get_income_snapshot().search
+    return search.search(query, citizenship_type, limit) if search is not None else []
 
 
+def get_cities(citizenship_type: str) -> tuple:
+    return get_income_snapshot().cities_by_type.get(citizenship_type, ())
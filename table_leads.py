@@ -1,20 +1,217 @@
+import os
+import json
+import fcntl
+import asyncio
+import hashlib
+import logging
+import random
 from datetime import datetime, timedelta
-from google_client import get_google_client
+from google_client import SheetsAPIError, SheetsNetworkError, get_sheets_client, sheets_breaker
+from idempotency import RecentIds
+from metrics import timed
+from workers import is_leader, try_become_leader
+logger = logging.getLogger(__name__)
 
 scopes = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive"
 ]
 
-client = get_google_client(scopes)
-sheet = client.open("ready_on_onboarding").sheet1
+LEADS_SPREADSHEET = "ready_on_onboarding"
+LEADS_SPREADSHEET_ID = os.environ.get("LEADS_SPREADSHEET_ID")
+# Без имени листа — первый лист таблицы
+LEADS_RANGE = "A:K"
 
-def save_lead(data: dict):
+
+async def get_spreadsheet_id() -> str:
+    # Токен и ID таблицы получаем при первом обращении (или прогреве), а не при импорте модуля
+    return await get_sheets_client(scopes).spreadsheet_id(LEADS_SPREADSHEET, LEADS_SPREADSHEET_ID)
+
+
+# === ОЧЕРЕДЬ ЛИДОВ ===
+# Sheets пропускает ~60 запросов на запись в минуту: один append_rows раз в секунду,
+# а всё, что накопилось за это время, уходит одним батчем
+LEAD_BATCH_SIZE = 500
+LEAD_FLUSH_INTERVAL = 1.0
+LEAD_MAX_RETRIES = 5
+# Коды, при которых имеет смысл повторить запрос (квота / временная ошибка Google)
+RETRYABLE_STATUSES = {429, 500, 502, 503}
+# Колонка K — ключ идемпотентности лида
+LEAD_ID_RANGE = "K:K"
+# Журнал лидов общий для всех воркеров; в таблицу его пишет только лидер
+LEADS_WAL_PATH = os.environ.get("LEADS_WAL_PATH", "leads.wal")
+
+_recent_leads = RecentIds(ttl=24 * 3600)
+
+_wal: "LeadWal | None" = None
+_worker_task: asyncio.Task | None = None
+
+
+class LeadWal:
+    """
+    Журнал лидов: append-only файл с JSON-строками и отдельный файл со смещением,
+    до которого строки уже записаны в таблицу.
+
+    Заявка считается принятой после fsync. Записи, пришедшие пока идёт fsync,
+    копятся и сбрасываются следующим одним fsync (group commit). После падения
+    всё, что лежит за сохранённым смещением, отправляется заново.
+    """
+
+    def __init__(self, path: str = LEADS_WAL_PATH):
+        self.path = path
+        self.offset_path = path + ".offset"
+        # O_APPEND + flock: строки из разных воркеров не перемешиваются
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._buffer: list[bytes] = []
+        self._waiters: list[asyncio.Future] = []
+        self._sync_task: asyncio.Task | None = None
+        # Строк после смещения — счётчик вместо чтения хвоста журнала на каждый /metrics.
+        # Лидер досчитывает только дописанное с прошлого раза (свои и чужие строки)
+        # и вычитает подтверждённые
+        self.pending = 0
+        self._counted_to = 0
+
+    # --- запись ---
+    async def append(self, row: list):
+        line = json.dumps(row, ensure_ascii=False).encode("utf-8") + b"\n"
+        future = asyncio.get_running_loop().create_future()
+        self._buffer.append(line)
+        self._waiters.append(future)
+        if self._sync_task is None:
+            self._sync_task = asyncio.create_task(self._sync(), name="lead-wal-sync")
+        await future
+
+    async def _sync(self):
+        try:
+            while self._buffer:
+                data, waiters = b"".join(self._buffer), self._waiters
+                self._buffer, self._waiters = [], []
+                try:
+                    with timed("lead_wal_fsync"):
+                        await asyncio.to_thread(self._write, data)
+                except Exception as e:
+                    for w in waiters:
+                        if not w.done():
+                            w.set_exception(e)
+                else:
+                    for w in waiters:
+                        if not w.done():
+                            w.set_result(None)
+        finally:
+            self._sync_task = None
+
+    def _write(self, data: bytes):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self._fd, view):]
+            os.fsync(self._fd)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    async def drain(self):
+        # Дожидаемся, пока всё принятое окажется на диске
+        while self._sync_task is not None:
+            await asyncio.shield(self._sync_task)
+
+    # --- чтение и подтверждение ---
+    def committed(self) -> int:
+        try:
+            with open(self.offset_path, "r", encoding="utf-8") as f:
+                offset = int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+        # Смещение дальше конца файла — журнал был обрезан, но смещение не успело обнулиться
+        return offset if offset <= os.path.getsize(self.path) else 0
+
+    def commit(self, offset: int, lines: int = 0):
+        """Строки до offset записаны в таблицу; lines — сколько их было для счётчика pending."""
+        tmp_path = self.offset_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.offset_path)
+        self.pending = max(0, self.pending - lines)
+
+    def read_pending(self, limit: int) -> tuple[list[list], int, int]:
+        """
+        Не больше limit целых строк после смещения, смещение за последней из них
+        и число прочитанных строк журнала (вместе с битыми).
+        """
+        offset = self.committed()
+        rows = []
+        lines = 0
+        with open(self.path, "rb") as f:
+            end = self._count_new_lines(f, offset)
+            f.seek(offset)
+            for line in f:
+                # Дальше посчитанного не читаем — иначе подтвердим строки, которых нет в pending
+                if offset + len(line) > end:
+                    break
+                offset += len(line)
+                lines += 1
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    logger.error("Skip corrupted lead WAL line: %r", line)
+                if len(rows) >= limit:
+                    break
+        return rows, offset, lines
+
+    def _count_new_lines(self, f, committed: int) -> int:
+        # Читаем только хвост, дописанный с прошлого подсчёта; недописанную строку оставляем на потом
+        start = max(self._counted_to, committed)
+        if start > os.fstat(f.fileno()).st_size:
+            # Журнал обрезан после сжатия — считаем заново
+            self.pending, start = 0, committed
+        f.seek(start)
+        self._counted_to = position = start
+        while chunk := f.read(1 << 20):
+            self.pending += chunk.count(b"\n")
+            last = chunk.rfind(b"\n")
+            if last >= 0:
+                self._counted_to = position + last + 1
+            position += len(chunk)
+        return self._counted_to
+
+    def compact(self):
+        # Всё отправлено — обрезаем журнал на месте, чтобы открытые дескрипторы воркеров остались валидны
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size and self.committed() == os.fstat(self._fd).st_size:
+                # Сначала нулевое смещение, потом обрезка: упав между ними, лидер лишь
+                # отправит журнал заново (дубли отсечёт сверка по колонке K). В обратном
+                # порядке старое смещение указало бы внутрь новых строк других воркеров
+                self.commit(0)
+                os.ftruncate(self._fd, 0)
+                self.pending, self._counted_to = 0, 0
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+def _get_wal() -> LeadWal:
+    global _wal
+    if _wal is None:
+        _wal = LeadWal()
+    return _wal
+
+
+def lead_id(data: dict, current_time: datetime) -> str:
+    # Один и тот же пользователь с теми же ответами в тот же день — это один лид
+    raw = "|".join(str(data.get(k, "")) for k in (
+        "user_id", "age", "citizenship", "city", "delivery"
+    )) + "|" + current_time.strftime("%Y-%m-%d")
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def build_row(data: dict) -> list:
     # Время с +4 часа
     current_time = datetime.utcnow() + timedelta(hours=4)
 
     # Приводим все значения к строкам, если данных нет — пустая строка
-    row = [
+    return [
         current_time.strftime("%Y-%m-%d %H:%M:%S"),
         data.get("user_id", ""),
         data.get("username", ""),
@@ -25,5 +222,122 @@ def save_lead(data: dict):
         data.get("day_income", ""),
         data.get("month_avg", ""),
         data.get("month_max", ""),
+        lead_id(data, current_time),
     ]
-    sheet.append_row(row)
+
+
+async def save_lead(data: dict):
+    # Время фиксируем в момент заявки, а не в момент записи в таблицу
+    row = build_row(data)
+    if _recent_leads.seen(row[-1]):
+        logger.info("Duplicate lead %s skipped", row[-1])
+        return
+    # Возвращаемся, когда заявка на диске; в таблицу её отправит фоновый воркер
+    try:
+        with timed("lead_wal_append"):
+            await _get_wal().append(row)
+    except BaseException:
+        # Заявка не легла в журнал — повторная попытка не должна считаться дублем
+        _recent_leads.discard(row[-1])
+        raise
+
+
+def get_queue_depth() -> int:
+    # Журнал разбирает лидер — очередь видна на его /metrics
+    return _get_wal().pending if is_leader() else 0
+
+
+async def _append_rows_with_retry(rows: list[list], ambiguous: bool = False):
+    client = get_sheets_client(scopes)
+    spreadsheet_id = await get_spreadsheet_id()
+    delay = 1.0
+    # После таймаута, 5xx или падения процесса запись могла пройти — перед отправкой сверяемся с таблицей
+    for attempt in range(LEAD_MAX_RETRIES):
+        if ambiguous:
+            with timed("sheets_lead_ids"):
+                (column,) = await client.batch_get(spreadsheet_id, [LEAD_ID_RANGE])
+            written = {str(cells[0]) for cells in column if cells}
+            rows = [r for r in rows if r[-1] not in written]
+            if not rows:
+                return
+        try:
+            with timed("sheets_append_rows"):
+                await client.append(spreadsheet_id, LEADS_RANGE, rows)
+            return
+        except SheetsAPIError as e:
+            status = e.status
+            if status not in RETRYABLE_STATUSES or attempt == LEAD_MAX_RETRIES - 1:
+                raise
+            ambiguous = status >= 500
+            logger.warning("Sheets returned %d, retry in %.1fs", status, delay)
+        except SheetsNetworkError:
+            if attempt == LEAD_MAX_RETRIES - 1:
+                raise
+            ambiguous = True
+            logger.warning("Sheets request failed, retry in %.1fs", delay)
+        await asyncio.sleep(delay + random.random())
+        delay *= 2
+
+
+async def _flush_wal(ambiguous: bool) -> int:
+    wal = _get_wal()
+    rows, offset, lines = await asyncio.to_thread(wal.read_pending, LEAD_BATCH_SIZE)
+    if not rows:
+        await asyncio.to_thread(wal.compact)
+        return 0
+    if not sheets_breaker.allow():
+        # Sheets лежит — лиды ждут в журнале, квоту не тратим
+        return 0
+    try:
+        await _append_rows_with_retry(rows, ambiguous=ambiguous)
+    except Exception:
+        sheets_breaker.failure()
+        raise
+    sheets_breaker.success()
+    await asyncio.to_thread(wal.commit, offset, lines)
+    logger.info("Saved %d leads", len(rows))
+    return len(rows)
+
+
+async def _lead_worker():
+    # Хвост журнала после рестарта мог уже попасть в таблицу
+    ambiguous = True
+    while True:
+        # Лидерство может перейти к этому воркеру, если прежний лидер упал
+        if try_become_leader():
+            try:
+                if await _flush_wal(ambiguous):
+                    ambiguous = False
+            except Exception:
+                # Лиды остаются в журнале и уйдут следующей попыткой
+                ambiguous = True
+                logger.exception("Failed to save leads, will retry")
+        await asyncio.sleep(LEAD_FLUSH_INTERVAL)
+
+
+def start_lead_worker():
+    global _worker_task
+    if _worker_task is None:
+        _get_wal()
+        _worker_task = asyncio.create_task(_lead_worker(), name="lead-worker")
+
+
+async def stop_lead_worker():
+    # Дожидаемся fsync принятых заявок и пробуем дописать журнал в таблицу перед остановкой
+    global _worker_task
+    if _worker_task is None:
+        return
+    await _get_wal().drain()
+    _worker_task.cancel()
+    try:
+        await _worker_task
+    except asyncio.CancelledError:
+        pass
+    _worker_task = None
+    if try_become_leader():
+        # Что не успели записать — останется в журнале до следующего запуска
+        try:
+            while await _flush_wal(ambiguous=True):
+                pass
+        except Exception:
+            logger.exception("Failed to save leads on shutdown, they stay in %s", LEADS_WAL_PATH)
@@ -0,0 +1,103 @@
+import asyncio
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("aiogram")
+
+import table_income  # noqa: E402
+
+ROWS = [
+    {"city": "Москва", "delivery": "foot", "day": "3 500", "month_avg": "70 000",
+     "month_max": "95 000", "eaes": "TRUE", "not_rf": "FALSE"},
+    {"city": "Казань", "delivery": "car", "day": "4000", "month_avg": "80000",
+     "month_max": "110000", "eaes": "FALSE", "not_rf": "TRUE"},
+]
+
+
+@pytest.fixture
+def cache_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "income_cache.json")
+    monkeypatch.setattr(table_income, "INCOME_CACHE_PATH", path)
+    monkeypatch.setattr(table_income, "_snapshot", table_income._EMPTY_SNAPSHOT)
+    monkeypatch.setattr(table_income, "_disk_mtime", None)
+    # Сервис считаем уже запущенным: get_income_snapshot не должен грузить файл повторно
+    monkeypatch.setattr(table_income, "_init_started", True)
+    monkeypatch.setattr(table_income, "_refresher_task", None)
+    monkeypatch.setattr(table_income, "_stopped", True)
+    return path
+
+
+def test_disk_snapshot_round_trip(cache_path):
+    table_income._save_disk_snapshot(ROWS, "2026-10-01T00:00:00Z", "abc")
+
+    assert table_income._load_disk_snapshot() == ("2026-10-01T00:00:00Z", "abc")
+    snapshot = table_income.get_income_snapshot()
+    assert snapshot.version == 1
+    assert len(snapshot.records) == 2
+    assert snapshot.by_key[("Москва", "foot")].day == 3500
+    assert table_income.estimate_income("Москва", "foot").day_text == "3 500"
+    assert snapshot.cities_by_type["eaes"] == ("Москва",)
+    assert snapshot.fetched_at > 0
+    assert not table_income._disk_snapshot_changed()
+
+
+def test_missing_disk_snapshot(cache_path):
+    assert table_income._load_disk_snapshot() == (None, None)
+    assert table_income.get_income_snapshot().version == 0
+
+
+class _SheetClient:
+    def __init__(self, values):
+        self.values = values
+
+    async def spreadsheet_id(self, name, spreadsheet_id=None):
+        return "sheet"
+
+    async def modified_time(self, spreadsheet_id):
+        return "2026-10-02T00:00:00Z"
+
+    async def batch_get(self, spreadsheet_id, ranges):
+        return [self.values]
+
+
+def test_empty_refresh_keeps_last_good_snapshot(cache_path, monkeypatch):
+    table_income._save_disk_snapshot(ROWS, "2026-10-01T00:00:00Z", "abc")
+    table_income._load_disk_snapshot()
+    monkeypatch.setattr(table_income, "get_sheets_client", lambda scopes: _SheetClient([["town", "mode"]]))
+    monkeypatch.setattr(table_income.sheets_breaker, "failures", 0)
+
+    assert asyncio.run(table_income._update_income(force=True)) == "failed"
+    assert len(table_income.get_income_snapshot().records) == 2
+    assert table_income.sheets_breaker.failures == 1
+    table_income._load_disk_snapshot()
+    assert len(table_income.get_income_snapshot().records) == 2
+
+
+def test_snapshot_read_after_stop_does_not_restart_service(cache_path, monkeypatch):
+    monkeypatch.setattr(table_income, "_stopped", False)
+
+    async def scenario():
+        table_income.init_income_service()
+        assert table_income._refresher_task is not None
+        await table_income.stop_income_service()
+        table_income.get_income_snapshot()
+        return table_income._refresher_task
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_unchanged_check_does_not_rebuild_follower_snapshot(cache_path):
+    table_income._save_disk_snapshot(ROWS, "2026-10-01T00:00:00Z", "abc")
+    table_income._load_disk_snapshot()
+    loaded = table_income.get_income_snapshot()
+
+    # Лидер сверился с таблицей — изменений нет
+    table_income._touch_disk_snapshot()
+    table_income._snapshot = loaded
+
+    assert not table_income._disk_snapshot_changed()
+    table_income._sync_checked_at()
+    snapshot = table_income.get_income_snapshot()
+    assert snapshot.version == loaded.version
+    assert snapshot.records is loaded.records
+    assert snapshot.fetched_at >= loaded.fetched_at
@@ -0,0 +1,164 @@
+import asyncio
+import pytest
+
+pytest.importorskip("aiogram")
+
+import table_leads  # noqa: E402
+from table_leads import LeadWal  # noqa: E402
+
+
+@pytest.fixture
+def wal_path(tmp_path):
+    return str(tmp_path / "leads.wal")
+
+
+def append_rows(wal, rows):
+    async def scenario():
+        await asyncio.gather(*(wal.append(row) for row in rows))
+    asyncio.run(scenario())
+
+
+def test_uncommitted_rows_are_replayed_after_restart(wal_path):
+    wal = LeadWal(wal_path)
+    append_rows(wal, [["a", 1], ["b", 2], ["c", 3]])
+
+    rows, offset, lines = wal.read_pending(2)
+    assert rows == [["a", 1], ["b", 2]]
+    wal.commit(offset, lines)
+
+    # Новый процесс видит только то, что не подтверждено
+    restarted = LeadWal(wal_path)
+    assert restarted.read_pending(10)[0] == [["c", 3]]
+
+
+def test_partial_line_is_left_for_the_next_read(wal_path):
+    wal = LeadWal(wal_path)
+    append_rows(wal, [["a", 1]])
+    with open(wal_path, "ab") as f:
+        f.write(b'["b", 2')
+
+    rows, offset, _ = wal.read_pending(10)
+    assert rows == [["a", 1]]
+    with open(wal_path, "ab") as f:
+        f.write(b"]\n")
+    wal.commit(offset)
+    assert wal.read_pending(10)[0] == [["b", 2]]
+
+
+def test_compact_truncates_only_fully_committed_journal(wal_path):
+    wal = LeadWal(wal_path)
+    append_rows(wal, [["a", 1], ["b", 2]])
+
+    rows, offset, _ = wal.read_pending(1)
+    wal.commit(offset)
+    wal.compact()
+    assert wal.read_pending(10)[0] == [["b", 2]]
+
+    wal.commit(wal.read_pending(10)[1])
+    wal.compact()
+    assert wal.committed() == 0
+    assert wal.read_pending(10) == ([], 0, 0)
+
+    append_rows(wal, [["c", 3]])
+    assert wal.read_pending(10)[0] == [["c", 3]]
+
+
+def test_crash_during_compact_resends_instead_of_losing_rows(wal_path, monkeypatch):
+    wal = LeadWal(wal_path)
+    append_rows(wal, [["a", 1], ["b", 2]])
+    wal.commit(wal.read_pending(10)[1])
+
+    def crash(fd, length):
+        raise OSError("killed")
+
+    monkeypatch.setattr(table_leads.os, "ftruncate", crash)
+    with pytest.raises(OSError):
+        wal.compact()
+    monkeypatch.undo()
+
+    # Другой воркер дописал строку, новый лидер читает журнал с начала
+    follower = LeadWal(wal_path)
+    append_rows(follower, [["c", 3]])
+    leader = LeadWal(wal_path)
+    assert leader.read_pending(10)[0] == [["a", 1], ["b", 2], ["c", 3]]
+
+
+def test_crash_after_truncate_does_not_skip_new_rows(wal_path, monkeypatch):
+    wal = LeadWal(wal_path)
+    append_rows(wal, [["a", 1]])
+    wal.commit(wal.read_pending(10)[1])
+    truncate = table_leads.os.ftruncate
+
+    def truncate_and_crash(fd, length):
+        truncate(fd, length)
+        raise OSError("killed")
+
+    monkeypatch.setattr(table_leads.os, "ftruncate", truncate_and_crash)
+    with pytest.raises(OSError):
+        wal.compact()
+    monkeypatch.undo()
+
+    # Журнал снова длиннее старого смещения — новые строки не должны потеряться
+    follower = LeadWal(wal_path)
+    new_rows = [["row", i] for i in range(5)]
+    append_rows(follower, new_rows)
+    assert LeadWal(wal_path).read_pending(10)[0] == new_rows
+
+
+def test_pending_counts_all_workers_rows_beyond_one_batch(wal_path):
+    leader = LeadWal(wal_path)
+    follower = LeadWal(wal_path)
+    append_rows(leader, [["own", i] for i in range(3)])
+    append_rows(follower, [["other", i] for i in range(7)])
+
+    rows, offset, lines = leader.read_pending(4)
+    assert len(rows) == 4
+    assert leader.pending == 10
+    leader.commit(offset, lines)
+    assert leader.pending == 6
+
+    # Недописанная строка не считается, пока не появится перевод строки
+    with open(wal_path, "ab") as f:
+        f.write(b'["late", 1]')
+    leader.read_pending(100)
+    assert leader.pending == 6
+    with open(wal_path, "ab") as f:
+        f.write(b"\n")
+    rows, offset, lines = leader.read_pending(100)
+    assert leader.pending == 7
+    leader.commit(offset, lines)
+    leader.compact()
+    assert leader.pending == 0
+
+    append_rows(follower, [["next", 1]])
+    leader.read_pending(100)
+    assert leader.pending == 1
+
+
+def test_pending_after_restart_counts_only_uncommitted_rows(wal_path):
+    wal = LeadWal(wal_path)
+    append_rows(wal, [["a", i] for i in range(5)])
+    _, offset, lines = wal.read_pending(2)
+    wal.commit(offset, lines)
+
+    restarted = LeadWal(wal_path)
+    restarted.read_pending(1)
+    assert restarted.pending == 3
+
+
+def test_failed_append_does_not_mark_lead_as_duplicate(wal_path, monkeypatch):
+    monkeypatch.setattr(table_leads, "_wal", LeadWal(wal_path))
+    monkeypatch.setattr(table_leads, "_recent_leads", table_leads.RecentIds(ttl=3600))
+    data = {"user_id": 1, "age": "18+", "citizenship": "Россия", "city": "Москва", "delivery": "foot"}
+    write = LeadWal._write
+
+    def broken_write(self, data):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(LeadWal, "_write", broken_write)
+    with pytest.raises(OSError):
+        asyncio.run(table_leads.save_lead(data))
+
+    monkeypatch.setattr(LeadWal, "_write", write)
+    asyncio.run(table_leads.save_lead(data))
+    assert len(table_leads._wal.read_pending(10)[0]) == 1
@@ -0,0 +1,77 @@
+import asyncio
+import pytest
+
+pytest.importorskip("aiogram")
+
+from aiogram.types import Update  # noqa: E402
+
+from update_queue import UpdateQueue  # noqa: E402
+
+
+def message_update(update_id: int, chat_id: int) -> Update:
+    return Update.model_validate({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "text": "hi",
+        },
+    })
+
+
+def test_spilled_chat_keeps_update_order(tmp_path):
+    handled = []
+    release = asyncio.Event()
+
+    async def handler(update):
+        await release.wait()
+        handled.append(update.update_id)
+
+    async def scenario():
+        queue = UpdateQueue(handler, workers=1, maxsize=1, policy="spill",
+                            spill_path=str(tmp_path / "spill.jsonl"))
+        queue.start()
+        assert queue.submit(message_update(1, 42))
+        await asyncio.sleep(0)            # воркер забрал первый апдейт и ждёт
+        assert queue.submit(message_update(2, 42))
+        assert queue.submit(message_update(3, 42))   # очередь полна — на диск
+        release.set()
+        await queue.join()
+        # В очереди снова есть место, но третий апдейт ещё на диске
+        assert queue.submit(message_update(4, 42))
+        assert queue.spilled == 2
+        for _ in range(50):
+            await asyncio.sleep(0.1)
+            if len(handled) == 4:
+                break
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert handled == [1, 2, 3, 4]
+
+
+def test_malformed_spilled_line_is_skipped(tmp_path):
+    handled = []
+
+    async def handler(update):
+        handled.append(update.update_id)
+
+    spill = tmp_path / "spill.jsonl"
+    spill.write_text(
+        message_update(1, 7).model_dump_json(exclude_none=True) + "\n" + '{"update_id": 2, "mess',
+        encoding="utf-8",
+    )
+
+    async def scenario():
+        queue = UpdateQueue(handler, workers=1, policy="spill", spill_path=str(spill))
+        queue.start()
+        for _ in range(30):
+            await asyncio.sleep(0.1)
+            if handled and not spill.exists():
+                break
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert handled == [1]
+    assert not (tmp_path / "spill.jsonl.processing").exists()
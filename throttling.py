@@ -0,0 +1,147 @@
+import os
+import time
+import logging
+from collections import OrderedDict
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery
+from metrics import callback_prefix, counter
+from workers import WORKERS
+logger = logging.getLogger(__name__)
+
+
+# === НАСТРОЙКИ ===
+THROTTLE_ENABLED = os.environ.get("THROTTLE_ENABLED", "1") == "1"
+# Лимит на пользователя по умолчанию: токенов в секунду и размер всплеска
+THROTTLE_RATE = float(os.environ.get("THROTTLE_RATE", "1"))
+THROTTLE_BURST = float(os.environ.get("THROTTLE_BURST", "5"))
+# Общий лимит апдейтов на бота в скользящем окне; делится между воркерами
+THROTTLE_GLOBAL_LIMIT = int(os.environ.get("THROTTLE_GLOBAL_LIMIT", "600"))
+THROTTLE_GLOBAL_WINDOW = float(os.environ.get("THROTTLE_GLOBAL_WINDOW", "10"))
+# Сколько бакетов (пользователь, группа) держать в памяти; вытесняются самые давние
+THROTTLE_MAXSIZE = int(os.environ.get("THROTTLE_MAXSIZE", "100000"))
+
+THROTTLED_TEXT = "Слишком часто 🙂 Подождите пару секунд"
+
+# Отдельные лимиты для действий, которые гоняют по кругу: каждое нажатие — это
+# правка сообщения и запись состояния. Формат переопределения в окружении:
+# THROTTLE_LIMITS="cities_page=2/8,shifts=0.5/3"
+ACTION_LIMITS = {
+    "cities_page": (2.0, 8.0),      # листание списка городов — быстрые серии нажатий
+    "delivery": (0.5, 3.0),
+    "shifts": (0.5, 4.0),
+    "income_recalc": (0.5, 3.0),
+    "send_lead": (0.2, 2.0),
+    "message": (0.5, 4.0),          # текстом ищут город — каждый запрос идёт в поиск
+}
+
+
+def parse_limits(value: str) -> dict[str, tuple[float, float]]:
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        try:
+            action, spec = item.split("=")
+            rate, burst = spec.split("/")
+            limits[action.strip()] = (float(rate), float(burst))
+        except ValueError:
+            logger.warning("Skip malformed THROTTLE_LIMITS entry %r", item)
+    return limits
+
+
+ACTION_LIMITS.update(parse_limits(os.environ.get("THROTTLE_LIMITS", "")))
+
+THROTTLED = counter("bot_throttled_total", "Updates dropped by rate limiting, by scope and action")
+
+
+class UserBuckets:
+    """
+    Токен-бакеты на (пользователь, группа) с ограничением по памяти.
+
+    Бакет — пара (токены, время обновления) в OrderedDict: вытесненный бакет
+    просто начинается заново полным, что для давно молчавшего пользователя и так верно.
+    """
+
+    def __init__(self, maxsize: int = THROTTLE_MAXSIZE):
+        self._maxsize = maxsize
+        self._buckets: OrderedDict = OrderedDict()
+
+    def allow(self, key, rate: float, burst: float) -> bool:
+        now = time.monotonic()
+        entry = self._buckets.pop(key, None)
+        tokens = burst if entry is None else min(burst, entry[0] + (now - entry[1]) * rate)
+        allowed = tokens >= 1
+        self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+        if len(self._buckets) > self._maxsize:
+            self._buckets.popitem(last=False)
+        return allowed
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class SlidingWindow:
+    """
+    Счётчик в скользящем окне без хранения отметок времени: текущее окно плюс
+    предыдущее с весом оставшейся доли — O(1) памяти при любой нагрузке.
+    """
+
+    def __init__(self, limit: int, window: float):
+        self.limit = limit
+        self.window = window
+        self._index = 0
+        self._current = 0
+        self._previous = 0
+
+    def allow(self) -> bool:
+        position = time.monotonic() / self.window
+        index = int(position)
+        if index != self._index:
+            self._previous = self._current if index == self._index + 1 else 0
+            self._current = 0
+            self._index = index
+        estimated = self._previous * (1 - (position - index)) + self._current
+        if estimated >= self.limit:
+            return False
+        self._current += 1
+        return True
+
+
+class ThrottleMiddleware(BaseMiddleware):
+    """
+    Ограничивает частоту апдейтов до хендлеров: токен-бакет на пользователя
+    (с отдельными лимитами для частых действий) и общее скользящее окно на бота.
+    На отброшенный коллбэк только отвечаем, чтобы не висели «часики»; хендлер,
+    FSM и правки сообщения не запускаются.
+    """
+
+    def __init__(self):
+        self.buckets = UserBuckets()
+        # Лимит на бота общий, а окно живёт в каждом воркере — делим поровну
+        self.window = SlidingWindow(max(1, THROTTLE_GLOBAL_LIMIT // WORKERS), THROTTLE_GLOBAL_WINDOW)
+
+    async def __call__(self, handler, event, data: dict):
+        user = getattr(event, "from_user", None)
+        if not THROTTLE_ENABLED or user is None:
+            return await handler(event, data)
+
+        is_callback = isinstance(event, CallbackQuery)
+        action = callback_prefix(event.data) if is_callback else "message"
+        group = action if action in ACTION_LIMITS else "default"
+        rate, burst = ACTION_LIMITS.get(group, (THROTTLE_RATE, THROTTLE_BURST))
+
+        # Сначала бакет пользователя: спамер упирается в свой лимит и не съедает общий
+        if not self.buckets.allow((user.id, group), rate, burst):
+            scope = "user"
+        elif not self.window.allow():
+            scope = "global"
+        else:
+            return await handler(event, data)
+
+        THROTTLED.inc(scope=scope, action=action)
+        if is_callback:
+            try:
+                await data["bot"].answer_callback_query(event.id, text=THROTTLED_TEXT)
+            except Exception:
+                logger.debug("Failed to answer throttled callback %s", event.id)
+        return None
@@ -0,0 +1,177 @@
+import os
+import glob
+import asyncio
+import logging
+from aiogram.types import Update
+from workers import is_multi_worker
+logger = logging.getLogger(__name__)
+
+
+# === НАСТРОЙКИ ===
+WEBHOOK_MODE = os.environ.get("WEBHOOK_MODE", "queue")  # queue | sync
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", "1000"))
+# Что делать при переполнении: drop — выкинуть, 429 — попросить Telegram повторить,
+# spill — дописать в файл на диске и обработать позже
+UPDATE_OVERFLOW_POLICY = os.environ.get("UPDATE_OVERFLOW_POLICY", "429")
+# При нескольких воркерах у каждого процесса свой файл: <путь>.<pid>
+UPDATE_SPILL_PATH = os.environ.get("UPDATE_SPILL_PATH", "updates_spill.jsonl")
+
+OVERFLOW_POLICIES = ("drop", "429", "spill")
+
+
+def update_chat_id(update: Update) -> int:
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return update.update_id
+
+
+class UpdateQueue:
+    """
+    Очередь входящих апдейтов с пулом воркеров.
+
+    Апдейты одного чата всегда попадают к одному и тому же воркеру,
+    поэтому обрабатываются строго по порядку.
+    """
+
+    def __init__(self, handler, workers=UPDATE_WORKERS, maxsize=UPDATE_QUEUE_SIZE,
+                 policy=UPDATE_OVERFLOW_POLICY, spill_path=UPDATE_SPILL_PATH):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self._handler = handler
+        self._policy = policy
+        self._spill_base = spill_path
+        self._spill_path = f"{spill_path}.{os.getpid()}" if is_multi_worker() else spill_path
+        self._processing_path = self._spill_path + ".processing"
+        self._queues = [asyncio.Queue(maxsize=maxsize) for _ in range(workers)]
+        self._tasks: list[asyncio.Task] = []
+        self.dropped = 0
+        self.spilled = 0
+        # chat_id -> сколько его апдейтов лежит на диске: пока они не вернулись в очередь,
+        # новые апдейты этого чата тоже идут на диск, иначе обгонят сброшенные
+        self._spilled_chats: dict[int, int] = {}
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def submit(self, update: Update) -> bool:
+        # False — апдейт не принят, вызывающая сторона должна ответить 429
+        chat_id = update_chat_id(update)
+        if chat_id in self._spilled_chats:
+            self._spill(update, chat_id)
+            return True
+        queue = self._queues[chat_id % len(self._queues)]
+        try:
+            queue.put_nowait(update)
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        if self._policy == "drop":
+            self.dropped += 1
+            logger.warning("Update queue full, dropped update %d", update.update_id)
+            return True
+        if self._policy == "spill":
+            self._spill(update, chat_id)
+            return True
+        return False
+
+    def _spill(self, update: Update, chat_id: int):
+        with open(self._spill_path, "a", encoding="utf-8") as f:
+            f.write(update.model_dump_json(exclude_none=True) + "\n")
+        self._spilled_chats[chat_id] = self._spilled_chats.get(chat_id, 0) + 1
+        self.spilled += 1
+
+    def _claim_spill(self) -> str | None:
+        # .processing остаётся, если процесс упал посреди прошлой выгрузки
+        if os.path.exists(self._processing_path):
+            return self._processing_path
+        for path in [self._spill_path, *self._orphaned_spills()]:
+            try:
+                # Переименование атомарно: файл упавшего процесса заберёт только один воркер
+                os.replace(path, self._processing_path)
+            except FileNotFoundError:
+                continue
+            return self._processing_path
+        return None
+
+    def _orphaned_spills(self):
+        # Файлы процессов, которых уже нет (перезапуск воркеров меняет pid)
+        for path in glob.glob(glob.escape(self._spill_base) + ".*"):
+            pid = path[len(self._spill_base) + 1:].split(".")[0]
+            if not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                yield path
+            except PermissionError:
+                pass
+
+    async def _replay_spill(self):
+        # Когда очередь разгрузилась — дочитываем сброшенные на диск апдейты
+        while True:
+            await asyncio.sleep(1)
+            if self.depth():
+                continue
+            try:
+                path = self._claim_spill()
+                if path is None:
+                    # На диске ничего не осталось (битые строки тоже не вернутся) — чаты снова идут в очередь
+                    self._spilled_chats.clear()
+                    continue
+                await self._replay_file(path)
+                os.remove(path)
+            except Exception:
+                # Задача живёт до остановки очереди: ошибка одного прохода не хоронит остальные апдейты
+                logger.exception("Failed to replay spilled updates")
+
+    async def _replay_file(self, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            for n, line in enumerate(f, 1):
+                try:
+                    update = Update.model_validate_json(line)
+                except ValueError:
+                    # Строка, оборванная падением процесса посреди записи
+                    logger.warning("Skip malformed spilled update at %s:%d", path, n)
+                    continue
+                chat_id = update_chat_id(update)
+                await self._queues[chat_id % len(self._queues)].put(update)
+                left = self._spilled_chats.get(chat_id, 0) - 1
+                if left > 0:
+                    self._spilled_chats[chat_id] = left
+                else:
+                    self._spilled_chats.pop(chat_id, None)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self._handler(update)
+            except Exception:
+                logger.exception("Failed to process update %d", update.update_id)
+            finally:
+                queue.task_done()
+
+    def start(self):
+        for i, queue in enumerate(self._queues):
+            self._tasks.append(asyncio.create_task(self._worker(queue), name=f"update-worker-{i}"))
+        if self._policy == "spill":
+            self._tasks.append(asyncio.create_task(self._replay_spill(), name="update-spill-replay"))
+
+    async def join(self):
+        # Ждём, пока все принятые апдейты будут обработаны
+        for queue in self._queues:
+            await queue.join()
+
+    async def stop(self):
+        # Дорабатываем всё, что уже принято, и гасим воркеры
+        await self.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
@@ -0,0 +1,45 @@
+import os
+import fcntl
+import logging
+import threading
+logger = logging.getLogger(__name__)
+
+
+# === НАСТРОЙКИ ===
+# Количество процессов uvicorn. При WORKERS > 1 общее состояние живёт в локальных файлах
+WORKERS = int(os.environ.get("WORKERS", "1"))
+LEADER_LOCK_PATH = os.environ.get("LEADER_LOCK_PATH", "bot.leader.lock")
+
+_lock = threading.Lock()
+_lock_file = None
+
+
+def is_multi_worker() -> bool:
+    return WORKERS > 1
+
+
+def try_become_leader() -> bool:
+    """
+    Лидер — единственный процесс, который ходит в Google за доходами, пишет лиды
+    в таблицу и ставит/снимает вебхук. Лидерство держится flock-ом до конца
+    жизни процесса; если лидер умер, замок снимает ОС и его забирает следующий.
+    """
+    global _lock_file
+    if not is_multi_worker():
+        return True
+    with _lock:
+        if _lock_file is not None:
+            return True
+        f = open(LEADER_LOCK_PATH, "a+")
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        _lock_file = f
+        logger.info("Worker %d became leader", os.getpid())
+        return True
+
+
+def is_leader() -> bool:
+    return not is_multi_worker() or _lock_file is not None